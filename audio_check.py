@@ -0,0 +1,157 @@
+"""
+Audio corruption checks for merges.
+
+Files are checked in batches on a thread pool (libsndfile releases the GIL
+while reading) and results are cached by (path, size, mtime) in a json file,
+so files already checked in an earlier run are not opened again.
+The default check only reads the header with sf.info; deep mode decodes the
+whole stream and checks the container is complete, which also catches
+truncated files (libsndfile quietly shortens those instead of failing).
+"""
+import json
+import os
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from metrics import metrics
+
+AUDIO_SUFFIXES = {".ogg", ".wav"}
+CACHE_FILE = "audio_check_cache.json"
+BLOCK_FRAMES = 65536
+OGG_TAIL_BYTES = 65536 + 282
+
+
+def header_ok(audio_file):
+    # soundfile loads libsndfile, only pay for it in runs that check audio
+    import soundfile as sf
+
+    sf.info(audio_file)
+    return True
+
+
+def wav_complete(f, size):
+    """The RIFF header's size must fit in the file (0 and 0xFFFFFFFF mean unknown)."""
+    head = f.read(12)
+    if len(head) < 12 or head[:4] != b"RIFF":
+        return head[:4] == b"RF64"
+    riff_size = struct.unpack("<I", head[4:8])[0]
+    return riff_size in (0, 0xFFFFFFFF) or size >= riff_size + 8
+
+
+def ogg_complete(f, size):
+    """The last Ogg page must be whole and flagged end-of-stream."""
+    f.seek(max(0, size - OGG_TAIL_BYTES))
+    tail = f.read()
+    start = tail.rfind(b"OggS")
+    if start < 0 or len(tail) - start < 27:
+        return False
+
+    header_type = tail[start + 5]
+    segments = tail[start + 26]
+    table = tail[start + 27:start + 27 + segments]
+    page_end = start + 27 + segments + sum(table)
+    return len(table) == segments and page_end == len(tail) and bool(header_type & 0x04)
+
+
+def decode_ok(audio_file):
+    """Decode every frame, then check the container wasn't cut short."""
+    import soundfile as sf
+
+    with sf.SoundFile(audio_file) as f:
+        frames = 0
+        for block in f.blocks(blocksize=BLOCK_FRAMES):
+            frames += len(block)
+        if frames < f.frames:
+            return False
+
+    suffix = Path(audio_file).suffix.lower()
+    with open(audio_file, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if suffix == ".wav":
+            return wav_complete(f, size)
+        if suffix == ".ogg":
+            return ogg_complete(f, size)
+    return True
+
+
+class AudioChecker:
+    def __init__(self, cache_file=CACHE_FILE, deep=False, workers=None):
+        self.deep = deep
+        self.cache_file = Path(cache_file) if cache_file else None
+        self.workers = workers or min(32, (os.cpu_count() or 1) * 4)
+        self._pool = None
+        self._lock = threading.Lock()
+        # (path, deep) → (size, mtime_ns, corrupt)
+        self.results = {}
+        self.hits = 0
+        self.misses = 0
+        self.load()
+
+    def load(self):
+        if not self.cache_file or not self.cache_file.exists():
+            return
+        try:
+            with open(self.cache_file, encoding="utf-8") as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            print(f"Ignoring unreadable audio check cache: {self.cache_file}")
+            return
+
+        for path, deep, size, mtime_ns, corrupt in entries:
+            self.results[(path, deep)] = (size, mtime_ns, corrupt)
+
+    def save(self):
+        if not self.cache_file:
+            return
+
+        entries = [
+            [path, deep, size, mtime_ns, corrupt]
+            for (path, deep), (size, mtime_ns, corrupt) in self.results.items()
+        ]
+        tmp = self.cache_file.with_name(self.cache_file.name + ".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(entries, f, ensure_ascii=False, separators=(",", ":"))
+        os.replace(tmp, self.cache_file)
+
+    def close(self):
+        metrics.cache("audio_check", self.hits, self.misses)
+        if self._pool:
+            self._pool.shutdown()
+            self._pool = None
+        self.save()
+
+    def is_corrupt(self, audio_file):
+        """Return True if the file is missing or can't be read, using the cache when possible."""
+        try:
+            st = os.stat(audio_file)
+        except OSError:
+            return True
+
+        key = (str(audio_file), self.deep)
+        cached = self.results.get(key)
+        if cached and cached[0] == st.st_size and cached[1] == st.st_mtime_ns:
+            with self._lock:
+                self.hits += 1
+            return cached[2]
+
+        try:
+            corrupt = not (decode_ok if self.deep else header_ok)(audio_file)
+        except Exception:
+            corrupt = True
+
+        with self._lock:
+            self.misses += 1
+            self.results[key] = (st.st_size, st.st_mtime_ns, corrupt)
+        return corrupt
+
+    def check_many(self, audio_files):
+        """Check a batch of files in parallel, returning path → corrupt."""
+        audio_files = list(audio_files)
+        if len(audio_files) < 2:
+            return {f: self.is_corrupt(f) for f in audio_files}
+
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.workers)
+        return dict(zip(audio_files, self._pool.map(self.is_corrupt, audio_files)))
@@ -0,0 +1,129 @@
+"""
+Resolve keysounds that exist both as .wav and .ogg in the same folder.
+
+beatoraja plays whichever of the two it finds, so after merging packs from
+several sources one of them is dead weight. Every pair is decoded in parallel
+with AudioChecker; the preferred format is kept when it's readable, the other
+one otherwise, and the redundant file goes to the journaled trash.
+"""
+import argparse
+import datetime
+import os
+from collections import defaultdict
+from pathlib import Path
+
+from audio_check import CACHE_FILE, AudioChecker
+from metrics import add_metrics_arguments, metrics, setup_metrics
+from trash import Trash
+
+FORMATS = (".ogg", ".wav")
+
+
+def find_audio_pairs(root):
+    """Return [[files with the same folder and stem]] for stems present in more than one format."""
+    pairs = []
+    for dirpath, _, filenames in os.walk(root):
+        by_stem = defaultdict(list)
+        for name in filenames:
+            stem, suffix = os.path.splitext(name)
+            if suffix.lower() in FORMATS:
+                by_stem[stem].append(Path(dirpath) / name)
+
+        for files in by_stem.values():
+            if len({f.suffix.lower() for f in files}) > 1:
+                pairs.append(sorted(files))
+    return pairs
+
+
+def choose_keep(files, corrupt, prefer):
+    """Return the file to keep, or None when every file is corrupt."""
+    readable = [f for f in files if not corrupt[f]]
+    if not readable:
+        return None
+    for f in readable:
+        if f.suffix.lower() == prefer:
+            return f
+    return readable[0]
+
+
+def resolve_audio_pairs(root, prefer=".ogg", checker=None, trash=None, dry_run=False):
+    """Trash the redundant file of every wav/ogg pair below root. Returns the bytes freed."""
+    # a checker or trash made here is closed here too
+    own_checker = checker is None
+    if own_checker:
+        checker = AudioChecker(cache_file=None, deep=True)
+    own_trash = trash is None and not dry_run
+    if own_trash:
+        trash = Trash()
+
+    try:
+        with metrics.phase("scan"):
+            pairs = find_audio_pairs(root)
+        print(f"Found {len(pairs)} wav/ogg pairs, decoding...")
+        with metrics.phase("audio_check"):
+            corrupt = checker.check_many(f for files in pairs for f in files)
+
+        freed = 0
+        for files in pairs:
+            keep = choose_keep(files, corrupt, prefer)
+            if keep is None:
+                print(f"SKIP (every file is corrupt): {files[0].with_suffix('')}")
+                continue
+
+            for f in files:
+                if f == keep:
+                    continue
+                reason = "corrupt" if corrupt[f] else f"{keep.suffix} kept"
+                size = f.stat().st_size
+                if dry_run:
+                    print(f"Would trash ({reason}): {f}")
+                elif trash.move(f):
+                    print(f"Trashed ({reason}): {f}")
+                else:
+                    print(f"SKIP (no write permission): {f}")
+                    continue
+                freed += size
+                metrics.count("bytes_freed", size)
+    finally:
+        if own_checker:
+            checker.close()
+        if own_trash:
+            trash.close()
+
+    return freed
+
+
+def main():
+    start = datetime.datetime.now()
+
+    parser = argparse.ArgumentParser(description="Keep one of every same-named wav and ogg keysound.")
+    parser.add_argument("--path", required=True, help="Path to root")
+    parser.add_argument("--prefer", choices=("ogg", "wav"), default="ogg", help="Format to keep when both are readable")
+    parser.add_argument("--dry-run", action="store_true", help="Only print what would be trashed")
+    parser.add_argument("--header-only", action="store_true", help="Only read headers instead of decoding whole files")
+    parser.add_argument("--audio-workers", type=int, help="Threads used to decode audio files")
+    parser.add_argument("--audio-cache", default=CACHE_FILE, help="File caching audio check results between runs")
+    parser.add_argument("--trash-dir", help="Single trash folder, instead of .bms-trash on each source's filesystem")
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+    setup_metrics(args)
+
+    checker = AudioChecker(args.audio_cache, deep=not args.header_only, workers=args.audio_workers)
+    trash = None if args.dry_run else Trash(root=args.trash_dir)
+    try:
+        freed = resolve_audio_pairs(Path(args.path).absolute(), "." + args.prefer, checker, trash, args.dry_run)
+    finally:
+        checker.close()
+        if trash:
+            trash.close()
+
+    print(f"{'Would free' if args.dry_run else 'Freed'} {freed / 1e6:.1f} MB")
+    if trash and trash.moved:
+        print(f"Trashed {trash.moved} files, undo with: python trash.py undo {trash.journal_path}")
+
+    end = datetime.datetime.now()
+    print("Completed in " + str(end - start))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""
+Generate synthetic libraries for the benchmarks: a scenario in the
+tests/merge.json schema, a matching song.db and a sparse chart tree.
+
+Run from the repository root to write a fixture, a song.db and a tree:
+    python -m bench.library --charts 1000000 --folders 100000 --out /tmp/library
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import sqlite3
+import zlib
+from pathlib import Path
+
+
+def generate_scenario(num_charts, num_folders, packs=50, overlap=0.2, max_copies=8, partial=0.3, seed=0):
+    """
+    Return a scenario {"priority_list", "files_by_hash"} like tests/merge.json.
+
+    Songs of 1-9 charts are spread over `packs` pack folders. A fraction
+    `overlap` of songs is also copied into other packs, the number of extra
+    copies falling off geometrically up to `max_copies`; a fraction `partial`
+    of those copies misses some charts, so both subsets and ties appear.
+    Generation stops at whichever of num_charts rows or num_folders comes first.
+    """
+    rng = random.Random(seed)
+    files_by_hash = {}
+    rows = 0
+    folder_id = 0
+    chart_id = 0
+
+    while rows < num_charts and folder_id < num_folders:
+        charts = [f"{chart_id + i:064x}" for i in range(rng.randint(1, 9))]
+        chart_id += len(charts)
+
+        copies = 1
+        if rng.random() < overlap:
+            while copies < max_copies and (copies == 1 or rng.random() < 0.5):
+                copies += 1
+
+        for copy in range(copies):
+            if rows >= num_charts or folder_id >= num_folders:
+                break
+            hashes = charts
+            if copy and len(charts) > 1 and rng.random() < partial:
+                hashes = rng.sample(charts, rng.randint(1, len(charts) - 1))
+
+            folder = f"pack_{rng.randrange(packs):03d}/song_{folder_id:07d}"
+            for sha256 in hashes:
+                files_by_hash.setdefault(sha256, []).append(f"{folder}/chart_{charts.index(sha256)}.bms")
+            rows += len(hashes)
+            folder_id += 1
+
+    return {
+        "priority_list": [f"pack_{i:03d}" for i in range(packs)],
+        "files_by_hash": files_by_hash,
+    }
+
+
+def write_fixture(path, scenario):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(scenario, f, indent="\t")
+
+
+def load_fixture(path):
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def write_song_db(db_path, scenario, root):
+    """Write a beatoraja-like song table with every file of the scenario below root."""
+    root = Path(root).absolute()
+    conn = sqlite3.connect(db_path)
+    conn.execute(
+        "CREATE TABLE song (md5 TEXT, sha256 TEXT, title TEXT, genre TEXT, artist TEXT, "
+        "path TEXT PRIMARY KEY, folder TEXT, date INTEGER, charthash TEXT)"
+    )
+
+    def rows():
+        for sha256, files in scenario["files_by_hash"].items():
+            for file in files:
+                path = str(root / file)
+                folder = f"{zlib.crc32(os.path.dirname(path).encode()):08x}"
+                yield sha256[:32], sha256, f"Song {file}", "Genre", "Artist", path, folder, 0, sha256
+
+    conn.executemany("INSERT INTO song VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows())
+    conn.commit()
+    conn.close()
+
+
+def write_tree(root, scenario, size=0):
+    """Create every chart file of the scenario below root, sparse when size > 0."""
+    root = Path(root)
+    if root.exists():
+        shutil.rmtree(root)
+
+    made = set()
+    for files in scenario["files_by_hash"].values():
+        for file in files:
+            path = root / file
+            if path.parent not in made:
+                path.parent.mkdir(parents=True, exist_ok=True)
+                made.add(path.parent)
+            with open(path, "wb") as f:
+                f.write(file.encode())
+                if size:
+                    f.truncate(size)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic library")
+    parser.add_argument("--charts", type=int, default=100000, help="Number of song rows")
+    parser.add_argument("--folders", type=int, default=20000, help="Maximum number of song folders")
+    parser.add_argument("--packs", type=int, default=50, help="Number of pack folders (priorities)")
+    parser.add_argument("--overlap", type=float, default=0.2, help="Fraction of songs copied into other packs")
+    parser.add_argument("--max-copies", type=int, default=8, help="Maximum folders holding one song")
+    parser.add_argument("--file-size", type=int, default=0, help="Sparse size of every chart file in bytes")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", required=True, help="Folder receiving library.json, song.db and library/")
+    parser.add_argument("--no-tree", action="store_true", help="Only write the fixture and song.db")
+    args = parser.parse_args()
+
+    out = Path(args.out)
+    out.mkdir(parents=True, exist_ok=True)
+    scenario = generate_scenario(args.charts, args.folders, args.packs, args.overlap, args.max_copies, seed=args.seed)
+
+    write_fixture(out / "library.json", scenario)
+    if (out / "song.db").exists():
+        (out / "song.db").unlink()
+    write_song_db(out / "song.db", scenario, out / "library")
+    if not args.no_tree:
+        write_tree(out / "library", scenario, args.file_size)
+
+    rows = sum(len(files) for files in scenario["files_by_hash"].values())
+    print(f"Wrote {rows} charts in {out}")
+
+
+if __name__ == "__main__":
+    main()
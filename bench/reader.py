@@ -0,0 +1,105 @@
+"""
+Measure load time and peak memory of song_reader against the old fetchall readers.
+
+Run from the repository root:
+    python -m bench.reader --rows 1000000
+"""
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+import time
+import tracemalloc
+from collections import defaultdict
+from pathlib import Path
+
+from song_reader import load_index
+
+
+def make_song_db(db_path, num_rows, seed=0):
+    """Write a song table of `num_rows` charts, about 5 charts per folder and 20% copied elsewhere."""
+    rng = random.Random(seed)
+    conn = sqlite3.connect(db_path)
+    conn.execute("CREATE TABLE song (sha256 TEXT, path TEXT PRIMARY KEY)")
+
+    def rows():
+        chart = 0
+        row = 0
+        while row < num_rows:
+            folder = f"charts/pack_{rng.randint(0, 499):03d}/song_{row:08d}"
+            for i in range(rng.randint(1, 9)):
+                sha256 = f"{chart:064x}" if rng.random() > 0.2 else f"{rng.randint(0, max(chart, 1)):064x}"
+                chart += 1
+                yield sha256, f"{folder}/chart_{i}.bms"
+                row += 1
+
+    conn.executemany("INSERT INTO song VALUES (?, ?)", rows())
+    conn.commit()
+    conn.close()
+
+
+def old_hashes_by_folder(cursor):
+    cursor.execute("SELECT sha256, path FROM song")
+    hashes_by_folder = defaultdict(list)
+    for sha256, file_path in cursor.fetchall():
+        hashes_by_folder[str(Path(file_path).parent)].append(sha256)
+    return hashes_by_folder
+
+
+def old_folders_by_hash(cursor):
+    folders_by_hash = defaultdict(list)
+    for sha256, file_path in cursor.execute("SELECT sha256, path FROM song"):
+        folder_path = str(Path(file_path).parent)
+        if folder_path not in folders_by_hash[sha256]:
+            folders_by_hash[sha256].append(Path(folder_path))
+    return folders_by_hash
+
+
+def old_reader(cursor):
+    return old_hashes_by_folder(cursor), old_folders_by_hash(cursor)
+
+
+def new_reader(cursor):
+    index = load_index(cursor)
+    return index, index.hashes_by_folder(), index.folders_by_hash()
+
+
+def measure(func, db_path):
+    """Return (seconds, peak traced bytes); timed and traced in separate runs."""
+    conn = sqlite3.connect(db_path)
+
+    start = time.perf_counter()
+    result = func(conn.cursor())
+    elapsed = time.perf_counter() - start
+    del result
+
+    tracemalloc.start()
+    result = func(conn.cursor())
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+
+    conn.close()
+    return elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark song.db readers")
+    parser.add_argument("--rows", type=int, default=200000, help="Number of synthetic song rows")
+    parser.add_argument("--db", help="Use an existing song.db instead of generating one")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = args.db
+        if not db_path:
+            db_path = os.path.join(tmp, "song.db")
+            make_song_db(db_path, args.rows)
+
+        for name, func in (("old fetchall", old_reader), ("song_reader", new_reader)):
+            elapsed, peak = measure(func, db_path)
+            print(f"{name:>12}: {elapsed:7.2f}s  peak {peak / 2**20:8.1f} MiB")
+
+
+if __name__ == "__main__":
+    main()
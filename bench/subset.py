@@ -0,0 +1,122 @@
+"""
+Compare dup_search.find_subset_statuses against the old pairwise overlap count.
+
+Run from the repository root:
+    python -m bench.subset --folders 20000 --charts 100000 --copies 20
+"""
+import argparse
+import random
+import time
+from collections import defaultdict
+
+from dup_search import find_subset_statuses
+
+
+def find_subset_statuses_pairwise(folder_dict):
+    """Reference implementation: count overlaps for every pair of folders sharing a hash."""
+    folder_sets = {
+        folder: set(hashes)
+        for folder, hashes in folder_dict.items()
+    }
+
+    folder_sizes = {f: len(s) for f, s in folder_sets.items()}
+    subset_status_by_folder = {f: False for f in folder_sets}
+
+    hash_to_folders = defaultdict(set)
+    for folder, hashes in folder_sets.items():
+        for h in hashes:
+            hash_to_folders[h].add(folder)
+
+    overlap_counts = defaultdict(lambda: defaultdict(int))
+
+    for folders in hash_to_folders.values():
+        folders = list(folders)
+        for f1 in folders:
+            for f2 in folders:
+                if f1 != f2:
+                    overlap_counts[f1][f2] += 1
+
+    for f1, overlaps in overlap_counts.items():
+        size1 = folder_sizes[f1]
+        if size1 == 0:
+            continue
+        for f2, shared in overlaps.items():
+            if shared == size1:
+                if folder_sizes[f2] > size1 or (folder_sizes[f2] == size1 and f2 < f1):
+                    subset_status_by_folder[f1] = True
+                    break
+
+    return subset_status_by_folder
+
+
+def build_folder_dict(num_folders, num_charts, copies, seed=0):
+    """
+    Build a synthetic folder → hashes mapping.
+
+    Each folder is a song (a handful of charts). A few popular songs are
+    copied into up to `copies` pack folders, some copies missing charts so
+    both subsets and ties appear.
+    """
+    rng = random.Random(seed)
+    folder_dict = {}
+    next_chart = 0
+    folder_id = 0
+
+    while folder_id < num_folders and next_chart < num_charts:
+        size = rng.randint(1, 8)
+        charts = [f"{c:064x}" for c in range(next_chart, next_chart + size)]
+        next_chart += size
+
+        popular = rng.random() < 0.1
+        num_copies = rng.randint(2, copies) if popular else rng.choice((1, 1, 1, 2))
+
+        for _ in range(num_copies):
+            if folder_id >= num_folders:
+                break
+            if rng.random() < 0.3 and len(charts) > 1:
+                hashes = rng.sample(charts, rng.randint(1, len(charts) - 1))
+            else:
+                hashes = list(charts)
+            folder_dict[f"pack_{rng.randint(0, 99):02d}/song_{folder_id:07d}"] = hashes
+            folder_id += 1
+
+    return folder_dict
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark subset detection")
+    parser.add_argument("--folders", type=int, default=20000, help="Number of synthetic folders")
+    parser.add_argument("--charts", type=int, default=100000, help="Upper bound on distinct charts")
+    parser.add_argument("--copies", type=int, default=20, help="Max folders holding a popular chart")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--skip-pairwise", action="store_true", help="Only time the new engine")
+    args = parser.parse_args()
+
+    folder_dict = build_folder_dict(args.folders, args.charts, args.copies, args.seed)
+    rows = sum(len(h) for h in folder_dict.values())
+    print(f"{len(folder_dict)} folders, {rows} rows")
+
+    new, new_time = timed(find_subset_statuses, folder_dict)
+    print(f"inverted index: {new_time:.3f}s ({sum(new.values())} subsets)")
+
+    if args.skip_pairwise:
+        return
+
+    old, old_time = timed(find_subset_statuses_pairwise, folder_dict)
+    print(f"pairwise:       {old_time:.3f}s ({sum(old.values())} subsets)")
+    print(f"speedup:        {old_time / new_time:.1f}x")
+
+    if old != new:
+        mismatched = [f for f in old if old[f] != new.get(f)]
+        raise SystemExit(f"results differ for {len(mismatched)} folders, e.g. {mismatched[:5]}")
+    print("results match")
+
+
+if __name__ == "__main__":
+    main()
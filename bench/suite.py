@@ -0,0 +1,165 @@
+"""
+Time the core functions of the dedup and export tools on a synthetic library.
+
+Every function is run --repeat times and the fastest wall time is kept; peak
+memory comes from one extra run under tracemalloc, so tracing doesn't skew
+the timings. Results are printed and written as json, and --compare prints
+the ratio against an earlier result file to spot regressions.
+
+Run from the repository root:
+    python -m bench.suite --charts 200000 --folders 40000 --json bench.json
+    python -m bench.suite --fixture tests/merge_chain.json
+"""
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import platform
+import sqlite3
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import dup_search
+import dup_search_v2
+import folders_to_json
+from audio_check import AudioChecker
+from bench.library import generate_scenario, load_fixture, write_song_db, write_tree
+from song_reader import load_duplicate_index, load_index, many_folders_by_hash
+from trash import Trash
+
+
+def measure(func, setup=None, repeat=3):
+    """Return (fastest seconds, peak traced bytes). setup() builds func's arguments, untimed."""
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        return _measure(func, setup, repeat)
+
+
+def _measure(func, setup, repeat):
+    times = []
+    for _ in range(repeat):
+        args = setup() if setup else ()
+        start = time.perf_counter()
+        result = func(*args)
+        times.append(time.perf_counter() - start)
+        del result
+
+    args = setup() if setup else ()
+    tracemalloc.start()
+    result = func(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+
+    return min(times), peak
+
+
+def run_suite(scenario, work, repeat=3, skip_fs=False):
+    """Measure every benchmark on the scenario, with its song.db and tree below work."""
+    library = work / "library"
+    db_path = work / "song.db"
+    write_song_db(db_path, scenario, library)
+    write_tree(library, scenario)
+
+    conn = sqlite3.connect(db_path)
+    index = load_index(conn.cursor())
+    priorities = [library / p for p in scenario["priority_list"]]
+
+    def fresh_cursor():
+        return (conn.cursor(),)
+
+    def fresh_tree():
+        write_tree(library, scenario)
+        trash = Trash(root=work / "trash", journal_dir=work / "trash")
+        return many_folders_by_hash(index), priorities, [], None, trash
+
+    benchmarks = {
+        "load_index": (load_index, fresh_cursor),
+        "load_duplicate_index": (load_duplicate_index, fresh_cursor),
+        "find_subset_statuses": (
+            dup_search.find_subset_statuses, lambda: (dup_search.build_hashes_by_folder(index),)
+        ),
+        "many_folders_by_hash_builder": (many_folders_by_hash, lambda: (index,)),
+        "create_table": (
+            folders_to_json.create_tables, lambda: (conn.cursor(), [library])
+        ),
+    }
+    if not skip_fs:
+        benchmarks["plan_deduplication"] = (
+            dup_search_v2.plan_deduplication,
+            lambda: (many_folders_by_hash(index), priorities, [], AudioChecker(cache_file=None)),
+        )
+        benchmarks["run_deduplication"] = (dup_search_v2.run_deduplication, fresh_tree)
+
+    results = {}
+    for name, (func, setup) in benchmarks.items():
+        seconds, peak = measure(func, setup, repeat)
+        results[name] = {"seconds": round(seconds, 4), "peak_mib": round(peak / 2**20, 2)}
+        print(f"{name:>28}: {seconds:8.3f}s  peak {peak / 2**20:8.1f} MiB")
+
+    conn.close()
+    return results
+
+
+def compare(results, previous):
+    print("\nAgainst previous run (time ratio, peak ratio, >1 is slower/bigger):")
+    for name, result in results.items():
+        before = previous.get(name)
+        if not before:
+            continue
+        time_ratio = result["seconds"] / before["seconds"] if before["seconds"] else float("inf")
+        peak_ratio = result["peak_mib"] / before["peak_mib"] if before["peak_mib"] else float("inf")
+        flag = "  <-- regression" if time_ratio > 1.2 or peak_ratio > 1.2 else ""
+        print(f"{name:>28}: {time_ratio:6.2f}x  {peak_ratio:6.2f}x{flag}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the dedup and export tools")
+    parser.add_argument("--charts", type=int, default=100000, help="Number of synthetic song rows")
+    parser.add_argument("--folders", type=int, default=20000, help="Maximum number of song folders")
+    parser.add_argument("--packs", type=int, default=50, help="Number of pack folders (priorities)")
+    parser.add_argument("--overlap", type=float, default=0.2, help="Fraction of songs copied into other packs")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--fixture", help="Use a scenario in the tests/merge.json schema instead of generating one")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs per benchmark, the fastest is kept")
+    parser.add_argument("--skip-fs", action="store_true", help="Skip the benchmarks that plan or move files")
+    parser.add_argument("--json", help="Write the results to this file")
+    parser.add_argument("--compare", help="Results file of an earlier run to compare against")
+    args = parser.parse_args()
+
+    if args.fixture:
+        scenario = load_fixture(args.fixture)
+        params = {"fixture": args.fixture}
+    else:
+        scenario = generate_scenario(args.charts, args.folders, args.packs, args.overlap, seed=args.seed)
+        params = {
+            "charts": args.charts, "folders": args.folders, "packs": args.packs,
+            "overlap": args.overlap, "seed": args.seed,
+        }
+
+    rows = sum(len(files) for files in scenario["files_by_hash"].values())
+    print(f"{rows} charts, {len(scenario['files_by_hash'])} distinct hashes")
+    params.update(rows=rows, repeat=args.repeat)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        results = run_suite(scenario, Path(tmp), args.repeat, args.skip_fs)
+
+    report = {
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "params": params,
+        "results": results,
+    }
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare(results, json.load(f)["results"])
+
+
+if __name__ == "__main__":
+    main()
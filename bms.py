@@ -0,0 +1,99 @@
+"""
+One command line for the library tools, sharing a single song.db read.
+
+    python bms.py --db song.db subset --remove + export --charts BMS --output tables
+
+Options before the first command (--db, --no-cache, --skip-check, --metrics,
+--profile) apply to the whole run. Commands are separated by "+" and run in
+order on the same Library, so the index an analysis loaded is reused by the
+commands after it. A tool's module is only imported when its command is
+used: `bms.py --help` doesn't load any of them.
+"""
+import argparse
+import importlib
+import sys
+
+from library import add_library_arguments, open_library
+from metrics import add_metrics_arguments, setup_metrics
+
+SEPARATOR = "+"
+
+# command → (module, what it does, needs song.db, changes the charts on disk)
+COMMANDS = {
+    "subset": ("dup_search", "Find folders whose charts all exist in another folder", True, False),
+    "merge": ("dup_search_v2", "Merge duplicate folders into the one of highest priority", False, True),
+    "trash": ("dup_search_v3", "Keep one copy of duplicate folders, trash the others", False, True),
+    "export": ("folders_to_json", "Write beatoraja table json of chart folders", True, False),
+    "convert": ("ogg", "Convert .wav keysounds to .ogg", False, False),
+}
+
+
+def split_commands(argv):
+    """Return (global options, [[command, its options...]]) of a command line."""
+    for start, arg in enumerate(argv):
+        if arg in COMMANDS:
+            break
+    else:
+        return argv, []
+
+    segments = [[]]
+    for arg in argv[start:]:
+        if arg == SEPARATOR:
+            segments.append([])
+        else:
+            segments[-1].append(arg)
+    return argv[:start], segments
+
+
+def parse_command(segment):
+    """Return (name, module, args) of one command, importing only its module."""
+    name, *argv = segment
+    module_name, description, _, _ = COMMANDS[name]
+    module = importlib.import_module(module_name)
+
+    parser = argparse.ArgumentParser(prog=f"bms.py {name}", description=description)
+    module.add_arguments(parser)
+    return name, module, parser.parse_args(argv)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    global_argv, segments = split_commands(argv)
+
+    parser = argparse.ArgumentParser(
+        description="Manage a beatoraja chart library.",
+        usage="%(prog)s [options] COMMAND [command options] [+ COMMAND [command options]]...",
+        epilog="commands:\n" + "\n".join(f"  {name:<9}{info[1]}" for name, info in COMMANDS.items())
+        + "\n\nSee %(prog)s COMMAND --help for the options of a command.",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    add_library_arguments(parser)
+    add_metrics_arguments(parser)
+    args = parser.parse_args(global_argv)
+
+    if not segments:
+        parser.error("a command is required")
+    for segment in segments:
+        if not segment or segment[0] not in COMMANDS:
+            parser.error(f"expected one of {', '.join(COMMANDS)} after {SEPARATOR}, got {' '.join(segment) or 'nothing'}")
+
+    # every command line is checked before anything runs
+    commands = [parse_command(segment) for segment in segments]
+    for name, _, _ in commands:
+        if COMMANDS[name][2] and not args.db:
+            parser.error(f"{name} needs --db")
+
+    setup_metrics(args)
+    library = open_library(args)
+    try:
+        for name, module, command_args in commands:
+            module.run(command_args, library)
+            if library and COMMANDS[name][3]:
+                library.reopen()
+    finally:
+        if library:
+            library.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,465 @@
+"""
+Dedup plans: the decisions of a v2/v3 run as data, and an executor for them.
+
+Planning only reads the filesystem. A plan is a gzipped file holding a json
+header line followed by one compact json array per operation:
+    ["merge", src_folder, dest_folder]   start of a folder merge (informational)
+    ["move", src, dest]                  move a file or folder to an exact path
+    ["trash", path, reason]              move a path to the trash
+
+apply_plan appends the index of every finished operation to <plan>.progress,
+so an interrupted run picks up where it stopped when the plan is applied again.
+Folder moves are also marked as started (s<index>), so a resume can tell a
+move it left halfway from a destination that was already there.
+apply_plan_parallel does the same for v2 plans, running merges that touch
+different folders side by side with a concurrency limit per disk.
+"""
+import datetime
+import gzip
+import json
+import os
+import shutil
+import stat
+import threading
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from devices import device_of, is_rotational
+from metrics import metrics
+from progress import Progress
+
+PLAN_VERSION = 1
+PLAN_DIR = Path("plans")
+FSYNC_EVERY = 500
+# concurrent merges per disk: one on a spinning disk, where more only seek
+HDD_JOBS = 1
+SSD_JOBS = 4
+
+
+class Plan:
+    def __init__(self, tool, ops=None, created=None):
+        self.tool = tool
+        self.ops = ops if ops is not None else []
+        self.created = created or datetime.datetime.now().isoformat(timespec="seconds")
+
+    def merge(self, src, dest):
+        self.ops.append(("merge", str(Path(src).absolute()), str(Path(dest).absolute())))
+
+    def move(self, src, dest):
+        self.ops.append(("move", str(Path(src).absolute()), str(Path(dest).absolute())))
+
+    def trash(self, path, reason):
+        self.ops.append(("trash", str(Path(path).absolute()), reason))
+
+    def counts(self):
+        counts = {}
+        for op in self.ops:
+            counts[op[0]] = counts.get(op[0], 0) + 1
+        return counts
+
+    def save(self, path=None):
+        if path is None:
+            PLAN_DIR.mkdir(exist_ok=True)
+            timestamp = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+            path = PLAN_DIR / f"{self.tool}_{timestamp}.plan.gz"
+        path = Path(path)
+
+        header = {"version": PLAN_VERSION, "tool": self.tool, "created": self.created, "ops": len(self.ops)}
+        tmp = path.with_name(path.name + ".tmp")
+        with gzip.open(tmp, "wt", encoding="utf-8") as f:
+            f.write(json.dumps(header) + "\n")
+            for op in self.ops:
+                f.write(json.dumps(op, ensure_ascii=False, separators=(",", ":")) + "\n")
+        os.replace(tmp, path)
+        return path
+
+    @classmethod
+    def load(cls, path):
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            header = json.loads(f.readline())
+            if header.get("version") != PLAN_VERSION:
+                raise ValueError(f"{path}: unsupported plan version {header.get('version')}")
+            ops = [tuple(json.loads(line)) for line in f if line.strip()]
+
+        if len(ops) != header["ops"]:
+            raise ValueError(f"{path}: plan is truncated ({len(ops)}/{header['ops']} operations)")
+        return cls(header["tool"], ops, header["created"])
+
+
+class PlanView:
+    """
+    The filesystem as it will look after the operations planned so far.
+
+    Planned moves and trashes are kept in an overlay of path → real path
+    holding its content (None when gone); everything else is read from disk.
+    """
+
+    def __init__(self):
+        self.overlay = {}
+        # folder → names of planned entries directly inside it
+        self.planned_children = defaultdict(set)
+
+    def real(self, path):
+        """Return the path on disk holding what `path` will contain, or None if it will be gone."""
+        path = Path(path)
+        for candidate in (path, *path.parents):
+            if candidate in self.overlay:
+                origin = self.overlay[candidate]
+                if origin is None:
+                    return None
+                return origin / path.relative_to(candidate)
+        return path
+
+    def exists(self, path):
+        real = self.real(path)
+        return real is not None and os.path.lexists(real)
+
+    def is_dir(self, path):
+        real = self.real(path)
+        return real is not None and os.path.isdir(real)
+
+    def iterdir(self, path):
+        path = Path(path)
+        real = self.real(path)
+        names = set(os.listdir(real)) if real is not None and os.path.isdir(real) else set()
+
+        for name in self.planned_children.get(path, ()):
+            if self.overlay[path / name] is None:
+                names.discard(name)
+            else:
+                names.add(name)
+
+        return [path / name for name in sorted(names) if self.exists(path / name)]
+
+    def _set(self, path, origin):
+        self.overlay[path] = origin
+        self.planned_children[path.parent].add(path.name)
+
+    def move(self, src, dest):
+        src, dest = Path(src), Path(dest)
+        self._set(dest, self.real(src))
+        self._set(src, None)
+
+    def trash(self, path):
+        self._set(Path(path), None)
+
+
+def progress_path(plan_path):
+    return Path(f"{plan_path}.progress")
+
+
+def read_progress(plan_path):
+    """Return the sets of indexes of the operations (applied, started but not applied)."""
+    done, started = set(), set()
+    try:
+        with open(progress_path(plan_path), encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if line.startswith("s"):
+                    started.add(int(line[1:]))
+                elif line:
+                    done.add(int(line))
+    except FileNotFoundError:
+        pass
+    return done, started - done
+
+
+def move_path(src, dest, trash):
+    """Move src to dest. Returns the bytes moved (0 for folders), or None when it lacks permission."""
+    try:
+        st = os.lstat(src)
+        shutil.move(src, dest)
+    except PermissionError:
+        print(f"SKIP (no write permission): {Path(dest).parent}")
+        return None
+    except FileNotFoundError:
+        print(f"SKIP (no longer there): {src}")
+        return None
+    trash.record(src, dest, "move")
+    size = st.st_size if stat.S_ISREG(st.st_mode) else 0
+    metrics.count("paths_moved")
+    metrics.count("bytes_moved", size)
+    return size
+
+
+def finish_move(src, dest, trash):
+    """
+    Finish a folder move to another disk that an interruption left halfway:
+    shutil.move copies the tree to dest before deleting src, so dest holds
+    part or all of it. The copy is redone into dest itself and src removed.
+    On one disk a move is a rename and can't be left halfway, dest was
+    written by something else and is left alone.
+    Returns 0, or None when it's skipped.
+    """
+    if device_of(src) == device_of(dest):
+        print(f"SKIP (destination exists): {dest}")
+        return None
+
+    try:
+        shutil.copytree(src, dest, symlinks=True, dirs_exist_ok=True)
+        shutil.rmtree(src)
+    except PermissionError:
+        print(f"SKIP (no write permission): {Path(dest).parent}")
+        return None
+    trash.record(src, dest, "move")
+    metrics.count("paths_moved")
+    return 0
+
+
+def is_folder(path):
+    return os.path.isdir(path) and not os.path.islink(path)
+
+
+def apply_op(op, args, trash, made_dirs, interrupted=False, mark_started=None):
+    """
+    Apply one plan operation. Returns the bytes moved.
+
+    interrupted tells a folder move it was started by an earlier attempt,
+    mark_started is called right before a folder move starts.
+    """
+    if op == "merge":
+        return 0
+
+    if op == "move":
+        src, dest = args
+        if not os.path.lexists(src):
+            # finished before an interruption
+            if not os.path.lexists(dest):
+                print(f"SKIP (no longer there): {src}")
+            return 0
+        if os.path.lexists(dest):
+            # interrupted while copying a folder across disks
+            if interrupted and is_folder(src):
+                return finish_move(src, dest, trash) or 0
+            print(f"SKIP (destination exists): {dest}")
+            return 0
+        parent = os.path.dirname(dest)
+        if parent not in made_dirs:
+            try:
+                os.makedirs(parent, exist_ok=True)
+            except PermissionError:
+                print(f"SKIP (no write permission): {parent}")
+                return 0
+            made_dirs.add(parent)
+        if mark_started and is_folder(src):
+            mark_started()
+        return move_path(src, dest, trash) or 0
+
+    if op == "trash":
+        path, reason = args
+        if not trash.move(path):
+            print(f"SKIP (no write permission): {path}")
+        return 0
+
+    raise ValueError(f"unknown plan operation: {op}")
+
+
+class Checkpoint:
+    """Records started and finished operations in <plan>.progress and on the progress line, from any thread."""
+
+    def __init__(self, plan_path, progress):
+        self.file = open(progress_path(plan_path), "a", encoding="utf-8") if plan_path else None
+        self.progress = progress
+        self.applied = 0
+        self._lock = threading.Lock()
+
+    def done(self, i, nbytes):
+        metrics.count("ops_applied")
+        with self._lock:
+            self.applied += 1
+            self.progress.advance(nbytes=nbytes)
+            if self.file:
+                self.file.write(f"{i}\n")
+                self.file.flush()
+                if self.applied % FSYNC_EVERY == 0:
+                    os.fsync(self.file.fileno())
+
+    def start(self, i):
+        if self.file:
+            with self._lock:
+                self.file.write(f"s{i}\n")
+                self.file.flush()
+
+    def apply(self, plan, i, trash, made_dirs, started):
+        """Apply operation i, started is the set of folder moves an earlier attempt left halfway."""
+        op, *args = plan.ops[i]
+        self.done(i, apply_op(op, args, trash, made_dirs, i in started, lambda: self.start(i)))
+
+    def close(self):
+        if self.file:
+            self.file.close()
+
+
+def start_checkpoint(plan, plan_path):
+    """Return (indexes already applied, indexes started but not applied, Checkpoint) for applying plan."""
+    done, started = read_progress(plan_path) if plan_path else (set(), set())
+    if done:
+        print(f"Resuming, {len(done)}/{len(plan.ops)} operations already applied")
+
+    progress = Progress("Applying", total=len(plan.ops) - len(done))
+    progress.start()
+    return done, started, Checkpoint(plan_path, progress)
+
+
+def apply_plan(plan, trash, plan_path=None):
+    """
+    Apply a plan in order. When plan_path is given, progress is checkpointed
+    next to it and operations finished by an earlier attempt are skipped.
+    """
+    done, started, checkpoint = start_checkpoint(plan, plan_path)
+    made_dirs = set()
+    try:
+        for i in range(len(plan.ops)):
+            if i in done:
+                continue
+            checkpoint.apply(plan, i, trash, made_dirs, started)
+    finally:
+        checkpoint.progress.close()
+        checkpoint.close()
+
+    return checkpoint.applied
+
+
+def merge_roots(plan):
+    """
+    Return the folders holding the destinations of the plan's merges, without
+    nesting: rehash.py --root walks them to find the folders a merge created.
+    """
+    parents = {Path(args[1]).parent for op, *args in plan.ops if op == "merge"}
+    return sorted(folder for folder in parents if not any(p in parents for p in folder.parents))
+
+
+def merge_units(plan):
+    """
+    Split a plan into units of operation indexes that can run concurrently.
+
+    Every merge op starts a segment lasting until the next one, whose other
+    operations stay below its source and destination folders. Segments whose
+    folders are the same or nested in one another are joined with union-find,
+    so only units touching unrelated folders run side by side. Operations
+    before the first merge (all of a v3 plan) form a unit without folders.
+    Returns [(folders, [op indexes])] in plan order.
+    """
+    segments = []
+    for i, (op, *args) in enumerate(plan.ops):
+        if op == "merge" or not segments:
+            folders = [Path(a) for a in args[:2]] if op == "merge" else []
+            segments.append((folders, []))
+        segments[-1][1].append(i)
+
+    parent = list(range(len(segments)))
+
+    def find(x):
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    def union(a, b):
+        a, b = find(a), find(b)
+        # the earlier segment stays the root, keeping units in plan order
+        parent[max(a, b)] = min(a, b)
+
+    owner = {}
+    for segment_id, (folders, _) in enumerate(segments):
+        for folder in folders:
+            union(owner.setdefault(folder, segment_id), segment_id)
+
+    for folder, segment_id in owner.items():
+        for ancestor in folder.parents:
+            if ancestor in owner:
+                union(owner[ancestor], segment_id)
+
+    units = {}
+    for segment_id, (folders, ops) in enumerate(segments):
+        unit = units.setdefault(find(segment_id), ([], []))
+        unit[0].extend(folders)
+        unit[1].extend(ops)
+
+    return [units[root] for root in sorted(units)]
+
+
+def apply_plan_parallel(plan, trash, plan_path=None, hdd_jobs=HDD_JOBS, ssd_jobs=SSD_JOBS):
+    """
+    Apply a v2 plan with independent merges running concurrently.
+
+    Units from merge_units are grouped by the disks they touch (source and
+    destination devices); each group gets its own workers, and every unit
+    holds a slot of each of its disks while it runs, hdd_jobs per spinning
+    disk and ssd_jobs per other disk. Within a unit, operations keep their
+    plan order. Checkpointing and resuming work as in apply_plan.
+    """
+    units = merge_units(plan)
+    # operations before the first merge may touch anything, they're applied first
+    prelude = units.pop(0)[1] if units and not units[0][0] else []
+
+    rotational = {}
+    groups = defaultdict(deque)
+    for folders, ops in units:
+        devices = set()
+        for folder in folders:
+            device = device_of(folder)
+            if device not in rotational:
+                rotational[device] = is_rotational(folder)
+            devices.add(device)
+        groups[tuple(sorted(devices, key=str))].append(ops)
+
+    limits = {device: hdd_jobs if hdd else ssd_jobs for device, hdd in rotational.items()}
+    slots = {device: threading.Semaphore(limit) for device, limit in limits.items()}
+    print(
+        f"Applying {len(units)} independent merges on {len(rotational)} disks "
+        f"({sum(rotational.values())} rotational), {len(groups)} disk combinations"
+    )
+
+    done, started, checkpoint = start_checkpoint(plan, plan_path)
+    made_dirs = set()
+    stop = threading.Event()
+    lock = threading.Lock()
+
+    def apply_ops(ops):
+        for i in ops:
+            if stop.is_set():
+                return
+            if i in done:
+                continue
+            checkpoint.apply(plan, i, trash, made_dirs, started)
+
+    def worker(devices, queue):
+        while not stop.is_set():
+            with lock:
+                if not queue:
+                    return
+                ops = queue.popleft()
+
+            # slots are always taken in the same order, so units can't deadlock
+            for device in devices:
+                slots[device].acquire()
+            try:
+                apply_ops(ops)
+            except BaseException:
+                stop.set()
+                raise
+            finally:
+                for device in reversed(devices):
+                    slots[device].release()
+
+    workers = [
+        (devices, queue)
+        for devices, queue in groups.items()
+        for _ in range(min(limits[device] for device in devices))
+    ]
+    executor = ThreadPoolExecutor(max_workers=max(len(workers), 1))
+    try:
+        apply_ops(prelude)
+        futures = [executor.submit(worker, devices, queue) for devices, queue in workers]
+        for future in futures:
+            future.result()
+    finally:
+        # an error or Ctrl-C stops the other workers after their current operation
+        stop.set()
+        executor.shutdown(wait=True)
+        checkpoint.progress.close()
+        checkpoint.close()
+
+    return checkpoint.applied
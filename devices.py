@@ -0,0 +1,38 @@
+"""
+Which disk a path lives on, used to size the parallelism of disk-bound work.
+
+Spinning disks get slower, not faster, with several concurrent readers, so
+ogg.py only runs a couple of encoders per HDD and the v2 merge executor one
+merge at a time, while SSDs get more.
+"""
+import os
+from pathlib import Path
+
+# concurrent encoders per spinning disk, more only makes the heads seek
+ROTATIONAL_JOBS = 2
+
+
+def device_of(path):
+    """Return st_dev of path, or of its nearest existing ancestor."""
+    path = Path(path)
+    for candidate in (path, *path.parents):
+        try:
+            return os.stat(candidate).st_dev
+        except OSError:
+            continue
+    return None
+
+
+def is_rotational(path):
+    """Best effort check whether path lives on a spinning disk (Linux only)."""
+    try:
+        st_dev = device_of(path)
+        block = Path(f"/sys/dev/block/{os.major(st_dev)}:{os.minor(st_dev)}").resolve()
+        # partitions don't have a queue, their parent device does
+        for device in (block, block.parent):
+            flag = device / "queue" / "rotational"
+            if flag.exists():
+                return flag.read_text().strip() == "1"
+    except (OSError, AttributeError, TypeError):
+        pass
+    return False
@@ -1,57 +1,68 @@
 import shutil
 import datetime
 import sys
-import sqlite3
 from pathlib import Path
 from collections import defaultdict
 import argparse
 
-def build_hashes_by_folder(database):
-    """Return a mapping of folder path → list of chart SHA256 hashes."""
-    database.execute("SELECT sha256, path FROM song")
+from library import add_library_arguments, open_library
+from metrics import add_metrics_arguments, metrics, setup_metrics
+from song_reader import iter_rows, make_folder_lookup, resolve_folder
 
-    hashes_by_folder = defaultdict(list)
+def build_hashes_by_folder(index):
+    """Return a mapping of folder path → chart hash ids."""
+    hashes_by_folder = index.hashes_by_folder()
 
-    for sha256, file_path in database.fetchall():
-        folder_path = str(Path(file_path).parent)
-        hashes_by_folder[folder_path].append(sha256)
-
-    return hashes_by_folder
-
-
-def find_subset_statuses(folder_dict):
-    """Determine if folders are subsets of others."""
-    folder_sets = {
-        folder: set(hashes)
-        for folder, hashes in folder_dict.items()
+    return {
+        folder: hashes_by_folder[folder_id]
+        for folder_id, folder in enumerate(index.folders)
     }
 
-    folder_sizes = {f: len(s) for f, s in folder_sets.items()}
-    subset_status_by_folder = {f: False for f in folder_sets}
 
-    hash_to_folders = defaultdict(set)
-    for folder, hashes in folder_sets.items():
+def find_subset_statuses(folder_dict):
+    """Determine if folders are subsets of others.
+
+    A folder is a subset when another folder holds all of its hashes and is
+    either larger, or the same size with a smaller name. Only folders that also
+    hold the rarest hash of the folder being checked can contain it, so those
+    are the only candidates tested.
+    """
+    folders = list(folder_dict)
+    folder_sets = [set(folder_dict[f]) for f in folders]
+
+    folders_by_hash = defaultdict(list)
+    for folder_id, hashes in enumerate(folder_sets):
         for h in hashes:
-            hash_to_folders[h].add(folder)
+            folders_by_hash[h].append(folder_id)
+
+    subset_status_by_folder = {}
 
-    overlap_counts = defaultdict(lambda: defaultdict(int))
+    for folder_id, hashes in enumerate(folder_sets):
+        folder = folders[folder_id]
+        subset_status_by_folder[folder] = False
 
-    for folders in hash_to_folders.values():
-        folders = list(folders)
-        for f1 in folders:
-            for f2 in folders:
-                if f1 != f2:
-                    overlap_counts[f1][f2] += 1
+        size = len(hashes)
+        if size == 0:
+            continue
 
-    for f1, overlaps in overlap_counts.items():
-        size1 = folder_sizes[f1]
-        if size1 == 0:
+        rarest = min(hashes, key=lambda h: len(folders_by_hash[h]))
+        candidates = folders_by_hash[rarest]
+        if len(candidates) == 1:
             continue
-        for f2, shared in overlaps.items():
-            if shared == size1:
-                if folder_sizes[f2] > size1 or (folder_sizes[f2] == size1 and f2 < f1):
-                    subset_status_by_folder[f1] = True
-                    break
+
+        for other_id in candidates:
+            if other_id == folder_id:
+                continue
+
+            other_size = len(folder_sets[other_id])
+            if other_size < size:
+                continue
+            if other_size == size and folders[other_id] >= folder:
+                continue
+
+            if hashes <= folder_sets[other_id]:
+                subset_status_by_folder[folder] = True
+                break
 
     return subset_status_by_folder
 
@@ -61,8 +72,13 @@ def find_maximal_folders(subset_status_by_folder):
     return [Path(f).name for f, subset in subset_status_by_folder.items() if not subset]
 
 
-def print_samples(cursor, subset_status_by_folder, num_samples):
-    """Print sample hashes with their folder subset statuses."""
+def print_samples(cursor, subset_status_by_folder, num_samples, near_duplicates=None, root=None):
+    """Print sample hashes with their folder subset statuses (and closest near-duplicate, if known).
+
+    root resolves relative paths like load_song_dbs does when several databases are combined.
+    """
+    near_duplicates = near_duplicates or {}
+
     cursor.execute("SELECT DISTINCT sha256 FROM song ORDER BY RANDOM() LIMIT ?", (num_samples,))
     sampled_hashes = cursor.fetchall()
     
@@ -74,67 +90,112 @@ def print_samples(cursor, subset_status_by_folder, num_samples):
         print(f"Hash: {sha256}")
         print("Paths:")
         for path in paths:
-            parent = str(Path(path).parent)
+            parent = resolve_folder(str(Path(path).parent), root)
             status = "Max" if not subset_status_by_folder.get(parent, False) else "Sub"
-            print(f"{status:>5} -> {parent}")
+            near = near_duplicates.get(parent)
+            if near and status == "Max":
+                print(f"{'Near':>5} -> {parent}  (~{near[0]:.2f} with {near[1]})")
+            else:
+                print(f"{status:>5} -> {parent}")
 
 
-def remove_subset_entries(cursor, subset_status_by_folder, dry_run=True):
-    """Remove all entries in subset folders from the database, with output."""
+def closest_near_duplicates(similar):
+    """Return folder → (jaccard, folder) of its most similar folder."""
+    closest = {}
+    for jaccard, a, b, *_ in similar:
+        for folder, other in ((a, b), (b, a)):
+            if folder not in closest or closest[folder][0] < jaccard:
+                closest[folder] = (jaccard, other)
+    return closest
 
-    subset_folders = [f for f, is_subset in subset_status_by_folder.items() if is_subset]
 
-    if not subset_folders:
-        return 0
+def print_near_duplicates(index, similar, threshold, list_charts=False):
+    """Print near-duplicate folder pairs; list_charts also lists the charts only one side has."""
+    print(f"\nNear-duplicate folder pairs (Jaccard >= {threshold}): {len(similar)}")
 
-    cursor.connection.create_function(
-        "get_parent", 1, lambda p: str(Path(p).parent)
-    )
+    for jaccard, a, b, shared, only_a, only_b in similar:
+        print(f"\n{jaccard:.3f}: {len(shared)} shared charts")
+        for folder, only in ((a, only_a), (b, only_b)):
+            print(f"  {len(only):>4} unique -> {folder}")
+            if list_charts:
+                for hash_id in sorted(only):
+                    print(f"           {index.hash_hex(hash_id)}")
 
-    cursor.execute("SELECT sha256, path FROM song")
-    all_rows = cursor.fetchall()
 
-    hash_to_folders = defaultdict(list)
-    for sha256, path in all_rows:
-        hash_to_folders[sha256].append(str(Path(path).parent))
+def print_origin_counts(index, subset_status_by_folder):
+    """Print maximal and subset folder counts of every database of a combined index."""
+    counts = defaultdict(lambda: [0, 0])
+    for folder_id, folder in enumerate(index.folders):
+        for name in index.origin_names(folder_id):
+            counts[name][subset_status_by_folder.get(folder, False)] += 1
 
-    rows = [
-        (sha256, path)
-        for sha256, path in all_rows
-        if str(Path(path).parent) in subset_folders
-    ]
+    print("\nPer database (a folder listed by several counts for each):")
+    for name in index.origins:
+        maximal, subset = counts[name]
+        print(f"  {maximal:>7} maximal, {subset:>7} subset -> {name}")
 
-    for sha256, path in rows:
-        parent = str(Path(path).parent)
-        others = [f for f in hash_to_folders[sha256] if f != parent]
 
-        print(f"DELETE {sha256}")
-        print(f"  from: {parent}")
+def write_delete_report(out, rows, hash_to_folders, chunk_size=1000):
+    """Stream the per-row delete report to `out`, writing in chunks."""
+    lines = []
+
+    for _, sha256, parent in rows:
+        lines.append(f"DELETE {sha256}\n  from: {parent}\n")
+
+        others = [f for f in hash_to_folders[sha256] if f != parent]
         if others:
-            print("  also in:")
-            for o in others:
-                print(f"    {o}")
+            lines.append("  also in:\n")
+            lines.extend(f"    {o}\n" for o in others)
         else:
-            print("  no other copies found")
+            lines.append("  no other copies found\n")
+
+        if len(lines) >= chunk_size:
+            out.writelines(lines)
+            lines.clear()
+
+    out.writelines(lines)
+    out.flush()
+
+
+def remove_subset_entries(databases, subset_status_by_folder, dry_run=True, batch_size=10000):
+    """Remove all entries in subset folders from the databases, with output.
+
+    databases is a list of (cursor, root), root resolving relative paths like
+    load_song_dbs does (None for a single database).
+    """
+
+    subset_folders = {f for f, is_subset in subset_status_by_folder.items() if is_subset}
+
+    if not subset_folders:
+        return 0
+
+    hash_to_folders = defaultdict(list)
+    rows = []
+
+    for db_id, (cursor, root) in enumerate(databases):
+        folder_of = make_folder_lookup(root)
+        for rowid, sha256, path in iter_rows(cursor, ("rowid", "sha256", "path")):
+            parent = folder_of(path)
+            hash_to_folders[sha256].append(parent)
+
+            if parent in subset_folders:
+                rows.append(((db_id, rowid), sha256, parent))
+
+    write_delete_report(sys.stdout, rows, hash_to_folders)
 
     if dry_run:
         print(f"\nWould delete {len(rows)} rows.")
         return len(rows)
 
-    cursor.execute("CREATE TEMP TABLE subset_folders (folder TEXT PRIMARY KEY)")
-    cursor.executemany(
-        "INSERT INTO subset_folders VALUES (?)",
-        [(f,) for f in subset_folders],
-    )
-
-    cursor.execute("""
-        DELETE FROM song
-        WHERE get_parent(path) IN (SELECT folder FROM subset_folders)
-    """)
-
-    removed_count = cursor.rowcount
-    cursor.execute("DROP TABLE subset_folders")
+    # rows are deleted inside the caller's transaction, committed by main
+    removed_count = 0
+    for db_id, (cursor, _) in enumerate(databases):
+        rowids = [rowid for (row_db, rowid), _, _ in rows if row_db == db_id]
+        for i in range(0, len(rowids), batch_size):
+            cursor.executemany("DELETE FROM song WHERE rowid = ?", ((rowid,) for rowid in rowids[i:i + batch_size]))
+            removed_count += cursor.rowcount
 
+    metrics.count("rows_deleted", removed_count)
     print(f"\nDeleted {removed_count} rows.")
     return removed_count
 
@@ -165,6 +226,7 @@ def move_folders_to_bac(subset_status_by_folder, charts_root, dry_run=True):
 
             dest.parent.mkdir(parents=True, exist_ok=True)
             shutil.move(str(src), str(dest))
+            metrics.count("paths_moved")
             print("  moved successfully")
 
             moved.append((src, dest))
@@ -177,67 +239,84 @@ def move_folders_to_bac(subset_status_by_folder, charts_root, dry_run=True):
     return moved
 
 
-def main():
-    parser = argparse.ArgumentParser(description="Analyze and manage duplicate folders in a beatoraja database.")
-    parser.add_argument("--db", required=True, help="Path to song.db")
+def add_arguments(parser):
     parser.add_argument("--samples", type=int, default=0, help="Print out a number of sample hashes to analyze")
     parser.add_argument("--remove", action="store_true", help="Remove redundant entries from the database, not from disk")
     parser.add_argument("--dry-run", action="store_true", help="Simulate folder moves")
     parser.add_argument("--charts-root", help="Root directory of your charts (required for moving)")
     parser.add_argument("--save-db", action="store_true", help="Save the db, useful for debugging")
-    args = parser.parse_args()
+    parser.add_argument(
+        "--similar",
+        type=float,
+        metavar="JACCARD",
+        help="Also report folder pairs sharing at least this fraction of their charts (e.g. 0.9), using MinHash/LSH"
+    )
 
-    while True:
-        user_input = input("Have you rebuilt your beatoraja database? (y/N): ")
-        if user_input.lower() == 'y':
-            break
-        else:
-            sys.exit()
 
+def run(args, library):
     timestamp = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
     if args.save_db:
-        db_path = Path(args.db)
         Path("saved_dbs").mkdir(exist_ok=True)
-        shutil.copyfile(db_path, Path(f"./saved_dbs/{timestamp}"))
+        for i, db_path in enumerate(library.db_paths):
+            name = timestamp if len(library.db_paths) == 1 else f"{timestamp}_{i}"
+            shutil.copyfile(db_path, Path(f"./saved_dbs/{name}"))
 
-    conn = sqlite3.connect(args.db)
-    cursor = conn.cursor()
+    index = library.index()
+    folder_dict = build_hashes_by_folder(index)
 
-    folder_dict = build_hashes_by_folder(cursor)
-    subset_status_by_folder = find_subset_statuses(folder_dict)
-    max_folders = find_maximal_folders(subset_status_by_folder)
+    with metrics.phase("find_subsets"):
+        subset_status_by_folder = find_subset_statuses(folder_dict)
+        max_folders = find_maximal_folders(subset_status_by_folder)
 
     #print("Maximal folders:")
     #for folder in sorted(max_folders):
     #    print(folder)
     print(f"\nTotal maximal folders: {len(max_folders)}")
     print(f"\nTotal subset folders: {len([folder for folder, is_sub in subset_status_by_folder.items() if is_sub])}")
+    if index.origins:
+        print_origin_counts(index, subset_status_by_folder)
+
+    near_duplicates = None
+    if args.similar:
+        # numpy is only needed for this report
+        from similarity import find_similar_folders
+
+        with metrics.phase("find_similar"):
+            similar = find_similar_folders(folder_dict, threshold=args.similar)
+        # pairs where one side holds everything are subsets, already counted above
+        similar = [pair for pair in similar if pair[4] and pair[5]]
+        # a dry run lists the charts each side would lose
+        print_near_duplicates(index, similar, args.similar, list_charts=args.dry_run)
+        near_duplicates = closest_near_duplicates(similar)
 
 
 
     if args.remove or args.dry_run:
-        removed_count = remove_subset_entries(
-            cursor,
-            subset_status_by_folder,
-            dry_run=args.dry_run
-        )
+        with metrics.phase("remove_entries"):
+            removed_count = remove_subset_entries(
+                library.databases(),
+                subset_status_by_folder,
+                dry_run=args.dry_run
+            )
 
     if args.remove and not args.dry_run:
-        conn.commit()
+        library.commit()
 
     if args.samples > 0:
-        print_samples(cursor, subset_status_by_folder, args.samples)
+        cursor, root = library.databases()[0]
+        print_samples(cursor, subset_status_by_folder, args.samples, near_duplicates, root)
 
     if args.dry_run or args.charts_root:
         if not args.charts_root:
             print("Error: --charts-root required when using --dry-run")
             return
             
-        moved = move_folders_to_bac(
-            subset_status_by_folder,
-            charts_root=args.charts_root,
-            dry_run=args.dry_run
-        )
+        with metrics.phase("move_folders"):
+            moved = move_folders_to_bac(
+                subset_status_by_folder,
+                charts_root=args.charts_root,
+                dry_run=args.dry_run
+            )
         
         backup_root = Path(args.charts_root).parent / f"{Path(args.charts_root).name}_bac"
         print(f"\nBackup location: {backup_root}")
@@ -250,7 +329,17 @@ def main():
             print(f"{status}: {src} -> {dest}")
         """
 
-    conn.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Analyze and manage duplicate folders in a beatoraja database.")
+    add_library_arguments(parser, required=True)
+    add_arguments(parser)
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+    setup_metrics(args)
+
+    with open_library(args) as library:
+        run(args, library)
 
 
 if __name__ == "__main__":
@@ -1,171 +1,194 @@
-import sqlite3
 import sys
 from pathlib import Path
 from collections import defaultdict
 import argparse
-import soundfile as sf
-import shutil
 import datetime
 
-def many_folders_by_hash_builder(cursor):
-    """
-    Return a mapping of hash → folders,
-    but only hashes that are owned by multiple folders
-    """
-
-    folders_by_hash = defaultdict(list)
-
-    for sha256, file_path in cursor.execute("SELECT sha256, path FROM song"):
-
-        folder_path = str(Path(file_path).parent)
-
-        if folder_path not in folders_by_hash[sha256]:
-            folders_by_hash[sha256].append(Path(folder_path))
-
-    many_folders_by_hash = {}
+from audio_check import AUDIO_SUFFIXES, CACHE_FILE, AudioChecker
+from dedup_plan import SSD_JOBS, Plan, PlanView, apply_plan, apply_plan_parallel, merge_roots
+from library import add_library_arguments, open_library
+from metrics import add_metrics_arguments, metrics, setup_metrics
+from progress import Progress
+from trash import Trash
 
-    for sha256 in folders_by_hash:
-        folders = folders_by_hash[sha256]
+def plan_move(src, dest, view, plan):
+    plan.move(src, dest)
+    view.move(src, dest)
 
-        if len(folders) > 1:
-            many_folders_by_hash[sha256] = folders
 
-    return many_folders_by_hash
+def plan_trash(path, reason, view, plan):
+    plan.trash(path, reason)
+    view.trash(path)
 
-def is_audio_corrupt(audio_file):
-    if not audio_file.exists():
-        return True
-    try:
-        sf.info(audio_file)
-    except Exception:
-        return True
-    return False
-
-def move_to_trash(src):
-    if not src.exists():
-        return
-
-    src = src.resolve()
-    relative_path = src.relative_to(src.anchor)
-    trash_dest = Path("./trash") / relative_path
-
-    trash_dest.parent.mkdir(parents=True, exist_ok=True)
-    safe_move(src, trash_dest)
-
-
-def safe_move(src, dst):
-    try:
-        shutil.move(src, dst)
-        return True
-    except PermissionError:
-        print(f"SKIP (no write permission): {dst.parent}")
-        return False
 
+def plan_merge_folder(src, dest, checker, view, plan):
+    """Plan merging folder into destination while preserving non-corrupt audio files."""
 
-def merge_folder_to_dest(src, dest):
-    """Merge folder into destination while preserving non-corrupt audio files."""
+    children = view.iterdir(src)
 
-    # snapshot children to avoid mutating the directory while iterating
-    children = list(src.iterdir())
+    # check every conflicting audio file of this folder in one parallel batch
+    conflicts = []
+    for src_child in children:
+        dest_child = dest / src_child.name
+        if src_child.suffix.lower() in AUDIO_SUFFIXES and view.exists(dest_child):
+            conflicts += [view.real(src_child), view.real(dest_child)]
+    checker.check_many(conflicts)
 
     for src_child in children:
         dest_child = dest / src_child.name
-        is_audio = src_child.suffix.lower() in {".ogg", ".wav"}
+        is_audio = src_child.suffix.lower() in AUDIO_SUFFIXES
 
-        if not dest_child.exists():
-            safe_move(src_child, dest)
+        if not view.exists(dest_child):
+            plan_move(src_child, dest_child, view, plan)
             continue
 
-        if src_child.is_dir():
-            if dest_child.is_dir():
-                merge_folder_to_dest(src_child, dest_child)
+        if view.is_dir(src_child):
+            if view.is_dir(dest_child):
+                plan_merge_folder(src_child, dest_child, checker, view, plan)
                 continue
             else:
-                move_to_trash(dest_child)
-                safe_move(src_child, dest)
+                plan_trash(dest_child, "file where a folder is merged", view, plan)
+                plan_move(src_child, dest_child, view, plan)
                 continue
 
         if is_audio:
-            src_ok = not is_audio_corrupt(src_child)
-            dest_ok = not is_audio_corrupt(dest_child)
+            src_ok = not checker.is_corrupt(view.real(src_child))
+            dest_ok = not checker.is_corrupt(view.real(dest_child))
 
             if src_ok and not dest_ok:
-                move_to_trash(dest_child)
-                safe_move(src_child, dest_child)
+                plan_trash(dest_child, "corrupt audio", view, plan)
+                plan_move(src_child, dest_child, view, plan)
                 continue
 
             if dest_ok:
-                move_to_trash(src_child)
+                plan_trash(src_child, "audio already in destination", view, plan)
                 continue
 
-        move_to_trash(src_child)
+        plan_trash(src_child, "already in destination", view, plan)
 
 
-def find_merge_folder(folders, folder_priorities):
+def find_merge_folder(folders, folder_priorities, view):
     for priority in folder_priorities:
         for folder in folders:
-            if not folder.exists():
+            if not view.exists(folder):
                 continue
             if folder == priority or priority in folder.parents:
                 return folder
 
     return sorted(folders)[0]
 
-def run_deduplication(folders_by_hash, folder_priorities, canon):
-    already_merged = set()
-    total = len(folders_by_hash)
-    for count, hash in enumerate(folders_by_hash, start=1):
-        print(f"Working ({count}/{total}): {hash}")
-        folders = folders_by_hash[hash]
-        merge_path = find_merge_folder(folders_by_hash[hash], folder_priorities)
-        did_merge = False
+def find_merge_components(folders_by_hash):
+    """
+    Group folders that share a hash, directly or through other folders,
+    using union-find so chained overlaps (ab -> bc -> cd) land in one group.
+    Groups and their folders are sorted, the plan doesn't depend on the
+    order song.db rows were read in.
+    """
+    parent = {}
 
+    def find(folder):
+        root = folder
+        while parent[root] != root:
+            root = parent[root]
+        while parent[folder] != root:
+            parent[folder], folder = root, parent[folder]
+        return root
+
+    for folders in folders_by_hash.values():
         for folder in folders:
-            if not folder.exists():
-                continue
-            if folder in already_merged:
-                continue
+            parent.setdefault(folder, folder)
 
-            folder_is_canon = (
-                    folder in canon or 
-                    bool(len(set(folder.parents).intersection(canon)))
-                )
+        first = find(folders[0])
+        for folder in folders[1:]:
+            root = find(folder)
+            if root != first:
+                parent[root] = first
 
-            if folder_is_canon:
-                continue
+    components = defaultdict(list)
+    for folder in parent:
+        components[find(folder)].append(folder)
 
-            if folder == merge_path:
-                continue
-            if merge_path in folder.parents:
-                continue
-            if folder in merge_path.parents:
-                continue
+    return sorted(sorted(folders) for folders in components.values())
 
-            merge_folder_to_dest(folder, merge_path)
-            print("Merged: " + str(folder))
-            did_merge = True
-            already_merged.add(folder)
 
-        if did_merge: print("Target: " + str(merge_path))
+def plan_deduplication(folders_by_hash, folder_priorities, canon, checker):
+    """Decide every merge, move and trash of a run without touching the filesystem."""
+    plan = Plan("v2")
+    view = PlanView()
 
+    components = find_merge_components(folders_by_hash)
+    with Progress("Planning", total=len(components)) as progress:
+        for folders in components:
+            progress.advance()
+            merge_path = find_merge_folder(folders, folder_priorities, view)
 
-def main():
+            for folder in folders:
+                if not view.exists(folder):
+                    continue
 
-    while True:
-        user_input = input("Have you rebuilt your beatoraja database? (y/N): ")
-        if user_input.lower() == 'y':
-            break
-        else:
-            sys.exit()
-        
-    start = datetime.datetime.now()
-    print(str(start) + "\nStarting...")
+                folder_is_canon = (
+                        folder in canon or 
+                        bool(len(set(folder.parents).intersection(canon)))
+                    )
 
-    parser = argparse.ArgumentParser(description="Analyze and manage duplicate folders in a beatoraja database.")
-    parser.add_argument("--db", required=True, help="Path to song.db")
+                if folder_is_canon:
+                    continue
+
+                if folder == merge_path:
+                    continue
+                if merge_path in folder.parents:
+                    continue
+                if folder in merge_path.parents:
+                    continue
+
+                plan.merge(folder, merge_path)
+                plan_merge_folder(folder, merge_path, checker, view, plan)
+
+    return plan
+
+
+def run_deduplication(folders_by_hash, folder_priorities, canon, checker=None, trash=None, plan_path=None, serial=False):
+    if checker is None:
+        checker = AudioChecker(cache_file=None)
+    if trash is None:
+        trash = Trash()
+
+    plan = plan_deduplication(folders_by_hash, folder_priorities, canon, checker)
+    if serial:
+        apply_plan(plan, trash, plan_path)
+    else:
+        apply_plan_parallel(plan, trash, plan_path)
+    return plan
+
+
+def print_plan_summary(plan, plan_path):
+    counts = plan.counts()
+    print(
+        f"Plan: {counts.get('merge', 0)} folder merges, {counts.get('move', 0)} moves, "
+        f"{counts.get('trash', 0)} trashes -> {plan_path}"
+    )
+
+
+def add_arguments(parser):
     parser.add_argument("--root-priority", nargs='+', help="Priority of folders to merge to, descending")
     parser.add_argument("--canon", nargs='+', help="Paths to never delete from")
-    args = parser.parse_args()
+    parser.add_argument("--sql-group", action="store_true", help="Let SQLite find duplicated hashes and only read their rows, instead of the index cache")
+    parser.add_argument("--deep-audio-check", action="store_true", help="Decode conflicting audio files fully instead of only reading headers")
+    parser.add_argument("--audio-workers", type=int, help="Threads used to check conflicting audio files")
+    parser.add_argument("--audio-cache", default=CACHE_FILE, help="File caching audio check results between runs")
+    parser.add_argument("--trash-dir", help="Single trash folder, instead of .bms-trash on each source's filesystem")
+    parser.add_argument("--plan-out", help="Only plan: write the plan to this file, no filesystem changes")
+    parser.add_argument("--apply", help="Apply (or resume) a plan written earlier instead of planning")
+    parser.add_argument("--ssd-jobs", type=int, default=SSD_JOBS, help="Concurrent merges per SSD (spinning disks always get one)")
+    parser.add_argument("--serial", action="store_true", help="Apply the plan one operation after another, in order")
+
+
+def run(args, library):
+    if library is None and not args.apply:
+        sys.exit("--db is required unless --apply is given")
+
+    start = datetime.datetime.now()
+    print(str(start) + "\nStarting...")
 
     root_priorities = []
     if args.root_priority:
@@ -177,17 +200,64 @@ def main():
         for root in args.canon:
             canon.append(Path(root).absolute())
 
-    conn = sqlite3.connect(args.db)
-    cursor = conn.cursor()
+    if args.apply:
+        plan_path = Path(args.apply)
+        plan = Plan.load(plan_path)
+    else:
+        index = library.duplicate_index(args.sql_group)
+        folders_by_hash = library.folders_by_hash(args.sql_group)
+        if index.origins:
+            shared = sum(len(origins) > 1 for origins in index.folder_origins)
+            print(f"Combined {len(index.origins)} databases: {len(index.folders)} folders, {shared} listed by more than one")
+
+        checker = AudioChecker(args.audio_cache, deep=args.deep_audio_check, workers=args.audio_workers)
+        try:
+            with metrics.phase("plan"):
+                plan = plan_deduplication(folders_by_hash, root_priorities, canon, checker)
+        finally:
+            checker.close()
+
+        plan_path = plan.save(args.plan_out)
+        print_plan_summary(plan, plan_path)
+
+    if not args.plan_out:
+        print(f"Applying plan, resume an interrupted run with: --apply {plan_path}")
+        trash = Trash(root=args.trash_dir)
+        try:
+            with metrics.phase("apply"):
+                if args.serial:
+                    apply_plan(plan, trash, plan_path)
+                else:
+                    apply_plan_parallel(plan, trash, plan_path, ssd_jobs=args.ssd_jobs)
+        finally:
+            trash.close()
+
+        if trash.moved:
+            print(f"Trashed {trash.moved} paths, undo with: python trash.py undo {trash.journal_path}")
+        if library:
+            # without --root, charts moved into folders the merges created would lose their rows
+            roots = " ".join(map(str, merge_roots(plan)))
+            print(f"Update song.db with: python rehash.py --db {' '.join(library.db_paths)}" + (f" --root {roots}" if roots else ""))
 
-    folders_by_hash = many_folders_by_hash_builder(cursor)
-
-    run_deduplication(folders_by_hash, root_priorities, canon)
-
-    conn.close()
     end = datetime.datetime.now()
     print(str(end) + "\nCompleted in " + str(end - start))
 
 
+def main():
+    parser = argparse.ArgumentParser(description="Analyze and manage duplicate folders in a beatoraja database.")
+    add_library_arguments(parser)
+    add_arguments(parser)
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+    setup_metrics(args)
+
+    library = open_library(args)
+    try:
+        run(args, library)
+    finally:
+        if library:
+            library.close()
+
+
 if __name__ == "__main__":
     main()
@@ -1,155 +1,192 @@
-import sqlite3
-import os
 import datetime 
-import sys
 from pathlib import Path
-from collections import defaultdict
 import argparse
-import shutil
-
+import json
 import logging
-logger = logging.getLogger(__name__)
-
-def many_folders_by_hash_builder(cursor):
-    """
-    Return a mapping of hash → folders,
-    but only hashes that are owned by multiple folders
-    """
-
-    folders_by_hash = defaultdict(list)
-
-    for sha256, file_path in cursor.execute("SELECT sha256, path FROM song"):
+import queue
+import shutil
+import sys
+from logging.handlers import QueueHandler, QueueListener
 
-        folder_path = str(Path(file_path).parent)
+from library import add_library_arguments, open_library
+from metrics import add_metrics_arguments, metrics, setup_metrics
+from progress import Progress
+from dedup_plan import Plan, apply_plan
+from fs_snapshot import FsSnapshot
+from trash import Trash
 
-        if folder_path not in folders_by_hash[sha256]:
-            folders_by_hash[sha256].append(Path(folder_path))
+logger = logging.getLogger(__name__)
 
-    many_folders_by_hash = {}
+LOG_LEVELS = {"debug": logging.DEBUG, "info": logging.INFO, "warning": logging.WARNING}
+# attributes every LogRecord has, anything else came in through `extra`
+STANDARD_RECORD_KEYS = set(logging.makeLogRecord({}).__dict__) | {"message", "asctime"}
 
-    for sha256 in folders_by_hash:
-        folders = folders_by_hash[sha256]
 
-        if len(folders) > 1:
-            many_folders_by_hash[sha256] = folders
+class JsonFormatter(logging.Formatter):
+    """One json object per record: time, level, message and the fields passed as `extra`."""
 
-    return many_folders_by_hash
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record, "%Y-%m-%d %H:%M:%S"),
+            "level": record.levelname,
+            "message": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in STANDARD_RECORD_KEYS:
+                entry[key] = value if isinstance(value, (int, float, bool)) or value is None else str(value)
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
 
-_folder_empty_cache = {}
-def folder_empty(path):
-    path = path.resolve()
 
-    cached = _folder_empty_cache.get(path)
-    if cached is not None:
-        return cached
+class LazyQueueHandler(QueueHandler):
+    """Hand records to the listener unformatted, so % formatting happens on the writer thread."""
 
-    with os.scandir(path) as folder:
-        for _ in folder:
-            _folder_empty_cache[path] = False
-            return False
+    def prepare(self, record):
+        return record
 
-    _folder_empty_cache[path] = True
-    return True
 
-def move_to_trash(src):
-    if not src.exists():
-        return
+def setup_logging(log_file, level):
+    """
+    Log to a json lines file through a queue. Returns (listener, handler):
+    stop the listener and remove the handler before exiting.
+    """
+    file_handler = logging.FileHandler(log_file, encoding="utf-8")
+    file_handler.setFormatter(JsonFormatter())
 
-    src = src.resolve()
-    relative_path = src.relative_to(src.anchor)
-    trash_dest = Path("./trash") / relative_path
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, file_handler)
 
-    trash_dest.parent.mkdir(parents=True, exist_ok=True)
-    try:
-        shutil.move(src, trash_dest)
-        return True
-    except PermissionError:
-        logger.info(f"SKIP (no write permission): {trash_dest.parent}")
-        return False
+    root = logging.getLogger()
+    root.setLevel(level)
+    handler = LazyQueueHandler(log_queue)
+    root.addHandler(handler)
+    listener.start()
+    return listener, handler
 
 
-def find_priority_folder(folders, folder_priorities):
+def find_priority_folder(folders, folder_priorities, snapshot):
     for priority in folder_priorities:
         for folder in folders:
-            if not folder.exists():
+            if not snapshot.exists(folder):
                 continue
-            if folder_empty(folder):
+            if snapshot.is_empty(folder):
                 continue
             if folder == priority or priority in folder.parents:
                 return folder
 
-    return min(folders, key=lambda p: len(p.parts))
+    # only a folder still on disk can keep the chart, None when every copy is gone
+    remaining = [folder for folder in folders if snapshot.exists(folder)]
+    if not remaining:
+        return None
+    return min(remaining, key=lambda p: len(p.parts))
 
 
-def run_deduplication(folders_by_hash, folder_priorities, canon_folders, dry_run):
+def plan_deduplication(folders_by_hash, folder_priorities, canon_folders, snapshot=None):
+    """Decide which folders to trash without touching the filesystem."""
+    if snapshot is None:
+        snapshot = FsSnapshot(f for folders in folders_by_hash.values() for f in folders)
+
+    plan = Plan("v3")
     already_removed = set()
-    total = len(folders_by_hash)
-    for count, sha256 in enumerate(folders_by_hash, start=1):
-        logger.info(f"Working: {sha256}")
-        print(f"\rWorking ({count}/{total})", end="", flush=True)
+    # per-hash records are skipped without building them unless running at debug level
+    debug = logger.isEnabledFor(logging.DEBUG)
+    with Progress("Planning", total=len(folders_by_hash)) as progress:
+        for sha256 in folders_by_hash:
+            progress.advance()
+            if debug:
+                logger.debug("Working: %s", sha256, extra={"event": "hash", "sha256": sha256})
+
+            folders = folders_by_hash[sha256]
+
+            priority = find_priority_folder(folders, folder_priorities, snapshot)
+            if priority is None:
+                continue
+            if debug:
+                logger.debug("Priority: %s", priority, extra={"event": "priority", "sha256": sha256, "folder": priority})
 
-        folders = folders_by_hash[sha256]
+            for folder in folders:
+                if not snapshot.exists(folder):
+                    continue
+                if folder in already_removed:
+                    continue
 
-        priority = find_priority_folder(folders, folder_priorities)
-        logger.info(f"Priority: {priority}")
+                folder_is_canon = any(folder == c or c in folder.parents for c in canon_folders)
 
-        for folder in folders:
-            if not folder.exists():
-                continue
-            if folder in already_removed:
-                continue
+                if folder_is_canon:
+                    continue
 
-            folder_is_canon = any(folder == c or c in folder.parents for c in canon_folders)
+                if snapshot.samefile(folder, priority):
+                    continue
+                if folder in priority.parents:
+                    continue
 
-            if folder_is_canon:
-                continue
+                plan.trash(folder, f"duplicate of {priority}")
+                snapshot.removed(folder)
 
-            if folder.samefile(priority):
-                continue
-            if folder in priority.parents:
-                continue
+                logger.info(
+                    "Trashing: %s", folder,
+                    extra={"event": "trash", "sha256": sha256, "folder": folder, "priority": priority},
+                )
+                already_removed.add(folder)
 
-            if not dry_run:
-                move_to_trash(folder)
+    logger.info("Filesystem snapshot: %d stat/scandir calls", snapshot.stat_calls, extra={"event": "snapshot", "stat_calls": snapshot.stat_calls})
+    metrics.count("stat_calls", snapshot.stat_calls)
+    return plan
 
-            logger.info(f"Trashing: {folder}")
-            already_removed.add(folder)
 
+def run_deduplication(folders_by_hash, folder_priorities, canon_folders, dry_run, trash=None, snapshot=None, plan_path=None):
+    plan = plan_deduplication(folders_by_hash, folder_priorities, canon_folders, snapshot)
 
-def main():
-    Path("logs").mkdir(exist_ok=True)
-    timestamp = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-    log_file = f"logs/{timestamp}.log"
-    logging.basicConfig(
-        filename=log_file,
-        format='%(asctime)s %(levelname)-8s %(message)s',
-        level=logging.DEBUG,
-        datefmt='%Y-%m-%d %H:%M:%S'
-    )
+    if not dry_run:
+        if trash is None:
+            trash = Trash()
+        apply_plan(plan, trash, plan_path)
 
-    parser = argparse.ArgumentParser(description="Analyze and manage duplicate folders in a beatoraja database.")
-    parser.add_argument("--db", required=True, help="Path to song.db")
+    return plan
+
+
+def add_arguments(parser):
     parser.add_argument("--root-priority", nargs='+', help="Priority of folders to merge to, descending")
     parser.add_argument("--canon", nargs='+', help="Paths to never delete from")
-    parser.add_argument("--dry-run", action="store_true", help="Simulate deduplication, no filesystem writes")
+    parser.add_argument("--sql-group", action="store_true", help="Let SQLite find duplicated hashes and only read their rows, instead of the index cache")
+    parser.add_argument("--dry-run", action="store_true", help="Simulate deduplication, no filesystem writes (the plan is still saved for review)")
     parser.add_argument("--save-db", action="store_true", help="Save the db, useful for debugging")
+    parser.add_argument("--trash-dir", help="Single trash folder, instead of .bms-trash on each source's filesystem")
+    parser.add_argument("--plan-out", help="Only plan: write the plan to this file, no filesystem changes")
+    parser.add_argument("--apply", help="Apply (or resume) a plan written earlier instead of planning")
+    parser.add_argument(
+        "--log-level",
+        choices=LOG_LEVELS,
+        default="info",
+        help="info logs every decision, debug also logs each hash (logs/<timestamp>.jsonl)"
+    )
 
-    args = parser.parse_args()
 
-    while True:
-        user_input = input("Have you rebuilt your beatoraja database? (y/N): ")
-        if user_input.lower() == 'y':
-            break
-        else:
-            sys.exit()
-        
+def run(args, library):
+    if library is None and not args.apply:
+        sys.exit("--db is required unless --apply is given")
+
+    timestamp = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+    Path("logs").mkdir(exist_ok=True)
+    listener, handler = setup_logging(f"logs/{timestamp}.jsonl", LOG_LEVELS[args.log_level])
+    try:
+        deduplicate(args, library, timestamp)
+    finally:
+        # flushes the records still queued
+        listener.stop()
+        logging.getLogger().removeHandler(handler)
+
+
+def deduplicate(args, library, timestamp):
     start = datetime.datetime.now()
     logger.info("Starting...")
 
-    if args.save_db:
-        db_path = Path(args.db)
+    if args.save_db and library:
         Path("saved_dbs").mkdir(exist_ok=True)
-        shutil.copyfile(db_path, Path(f"./saved_dbs/{timestamp}"))
+        for i, db_path in enumerate(library.db_paths):
+            name = timestamp if len(library.db_paths) == 1 else f"{timestamp}_{i}"
+            shutil.copyfile(db_path, Path(f"./saved_dbs/{name}"))
 
     root_priorities = []
     if args.root_priority:
@@ -161,16 +198,61 @@ def main():
         for root in args.canon:
             canon.append(Path(root).absolute())
 
-    conn = sqlite3.connect(args.db)
-    cursor = conn.cursor()
+    if args.apply:
+        plan_path = Path(args.apply)
+        plan = Plan.load(plan_path)
+    else:
+        index = library.duplicate_index(args.sql_group)
+        folders_by_hash = library.folders_by_hash(args.sql_group)
+        if index.origins:
+            shared = sum(len(origins) > 1 for origins in index.folder_origins)
+            logger.info(
+                "Combined %d databases: %d folders, %d listed by more than one", len(index.origins), len(index.folders), shared,
+                extra={"event": "databases", "databases": index.origins},
+            )
+
+        with metrics.phase("plan"):
+            plan = plan_deduplication(folders_by_hash, root_priorities, canon)
+            plan_path = plan.save(args.plan_out)
+        logger.info("Plan: %d folders to trash -> %s", len(plan.ops), plan_path, extra={"event": "plan", "plan": plan_path})
+
+    if not (args.dry_run or args.plan_out):
+        logger.info("Applying plan, resume an interrupted run with: --apply %s", plan_path)
+        trash = Trash(run_id=timestamp, root=args.trash_dir)
+        try:
+            with metrics.phase("apply"):
+                apply_plan(plan, trash, plan_path)
+        finally:
+            trash.close()
+
+        if trash.moved:
+            logger.info(
+                "Trashed %d folders, undo with: python trash.py undo %s", trash.moved, trash.journal_path,
+                extra={"event": "applied", "journal": trash.journal_path},
+            )
+        if library:
+            # v3 creates no folders, walking the priority roots finds charts moved in since beatoraja's update
+            roots = f" --root {' '.join(map(str, root_priorities))}" if root_priorities else ""
+            logger.info("Update song.db with: python rehash.py --db %s%s", " ".join(library.db_paths), roots)
 
-    folders_by_hash = many_folders_by_hash_builder(cursor)
+    end = datetime.datetime.now()
+    logger.info("Completed in %s", end - start)
 
-    run_deduplication(folders_by_hash, root_priorities, canon, args.dry_run)
 
-    conn.close()
-    end = datetime.datetime.now()
-    logger.info("Completed in " + str(end - start))
+def main():
+    parser = argparse.ArgumentParser(description="Analyze and manage duplicate folders in a beatoraja database.")
+    add_library_arguments(parser)
+    add_arguments(parser)
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+    setup_metrics(args)
+
+    library = open_library(args)
+    try:
+        run(args, library)
+    finally:
+        if library:
+            library.close()
 
 
 if __name__ == "__main__":
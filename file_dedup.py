@@ -0,0 +1,259 @@
+"""
+Replace byte-identical files (keysounds, BGAs, ...) across packs with links.
+
+Files are compared in stages so most of them are never read in full:
+same size, then a hash of their first and last 64 KiB, then a hash of the
+whole file read through mmap. Hashing runs on a thread pool (hashlib releases
+the GIL on large buffers) and digests are cached by (device, inode, size,
+mtime), so a rescan only reads new or changed files.
+
+Duplicates are replaced by a hardlink to one copy, or a reflink (FICLONE)
+on filesystems that share extents like btrfs and XFS, so every chart keeps
+finding its files.
+"""
+import argparse
+import datetime
+import fcntl
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import stat
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from metrics import add_metrics_arguments, metrics, setup_metrics
+from trash import TRASH_DIR
+
+CACHE_FILE = "file_hash_cache.json"
+PARTIAL_BYTES = 64 * 1024
+CHUNK_BYTES = 8 * 1024 * 1024
+MIN_SIZE = 4096
+# _IOW(0x94, 9, int) from linux/fs.h
+FICLONE = 0x40049409
+
+
+def partial_digest(path, size):
+    """Hash of the first and last PARTIAL_BYTES, the whole file when it's small."""
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        h.update(f.read(PARTIAL_BYTES))
+        if size > 2 * PARTIAL_BYTES:
+            f.seek(size - PARTIAL_BYTES)
+        h.update(f.read(PARTIAL_BYTES))
+    return h.hexdigest()
+
+
+def full_digest(path):
+    h = hashlib.blake2b(digest_size=32)
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return h.hexdigest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            view = memoryview(m)
+            try:
+                for offset in range(0, len(m), CHUNK_BYTES):
+                    h.update(view[offset:offset + CHUNK_BYTES])
+            finally:
+                view.release()
+    return h.hexdigest()
+
+
+class HashCache:
+    """Digests by "dev:ino", valid while size and mtime don't change."""
+
+    def __init__(self, cache_file=CACHE_FILE):
+        self.cache_file = Path(cache_file) if cache_file else None
+        # "dev:ino" → [size, mtime_ns, partial, full]
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        if self.cache_file and self.cache_file.exists():
+            try:
+                with open(self.cache_file, encoding="utf-8") as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError):
+                print(f"Ignoring unreadable hash cache: {self.cache_file}")
+
+    def get(self, st, kind):
+        entry = self.entries.get(f"{st.st_dev}:{st.st_ino}")
+        if entry and entry[0] == st.st_size and entry[1] == st.st_mtime_ns and entry[kind]:
+            self.hits += 1
+            return entry[kind]
+        self.misses += 1
+        return None
+
+    def put(self, st, kind, digest):
+        key = f"{st.st_dev}:{st.st_ino}"
+        entry = self.entries.get(key)
+        if not entry or entry[0] != st.st_size or entry[1] != st.st_mtime_ns:
+            entry = self.entries[key] = [st.st_size, st.st_mtime_ns, None, None]
+        entry[kind] = digest
+
+    def save(self):
+        metrics.cache("file_hash", self.hits, self.misses)
+        if not self.cache_file:
+            return
+        tmp = self.cache_file.with_name(self.cache_file.name + ".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.entries, f, separators=(",", ":"))
+        os.replace(tmp, self.cache_file)
+
+
+PARTIAL = 2
+FULL = 3
+
+
+def scan_files(roots, min_size=MIN_SIZE):
+    """
+    Return [(path, stat)] of the regular files below roots, one per inode,
+    and the number of paths that were already links to another one.
+    """
+    files = {}
+    already_linked = 0
+    for root in roots:
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames[:] = [d for d in dirnames if d != TRASH_DIR]
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                st = os.lstat(path)
+                if not stat.S_ISREG(st.st_mode) or st.st_size < min_size:
+                    continue
+                key = (st.st_dev, st.st_ino)
+                if key in files:
+                    already_linked += 1
+                    continue
+                files[key] = (path, st)
+    return list(files.values()), already_linked
+
+
+def refine(groups, kind, cache, pool):
+    """Split every group of (path, stat) by digest, dropping files without a twin."""
+    digests = {}
+    todo = []
+    for files in groups:
+        for path, st in files:
+            digests[path] = cache.get(st, kind)
+            if digests[path] is None:
+                todo.append((path, st))
+
+    def digest(item):
+        path, st = item
+        return partial_digest(path, st.st_size) if kind == PARTIAL else full_digest(path)
+
+    for (path, st), value in zip(todo, pool.map(digest, todo)):
+        cache.put(st, kind, value)
+        digests[path] = value
+
+    refined = []
+    for files in groups:
+        by_digest = defaultdict(list)
+        for path, st in files:
+            by_digest[digests[path]].append((path, st))
+        refined += [same for same in by_digest.values() if len(same) > 1]
+    return refined
+
+
+def find_duplicates(roots, cache, workers=None, min_size=MIN_SIZE):
+    """Return [[(path, stat)]] of identical files on the same filesystem."""
+    with metrics.phase("scan"):
+        files, already_linked = scan_files(roots, min_size)
+    metrics.count("files_scanned", len(files))
+    print(f"Scanned {len(files)} files ({already_linked} paths already linked)")
+
+    by_size = defaultdict(list)
+    for path, st in files:
+        by_size[(st.st_dev, st.st_size)].append((path, st))
+    groups = [same for same in by_size.values() if len(same) > 1]
+    print(f"{sum(map(len, groups))} files share their size with another one")
+
+    with ThreadPoolExecutor(max_workers=workers or min(32, (os.cpu_count() or 1) * 2)) as pool:
+        with metrics.phase("partial_hash"):
+            groups = refine(groups, PARTIAL, cache, pool)
+        print(f"{sum(map(len, groups))} files share their partial hash")
+
+        # the partial hash already covered the whole of small files
+        small = [same for same in groups if same[0][1].st_size <= 2 * PARTIAL_BYTES]
+        large = [same for same in groups if same[0][1].st_size > 2 * PARTIAL_BYTES]
+        with metrics.phase("full_hash"):
+            groups = small + refine(large, FULL, cache, pool)
+
+    return groups
+
+
+def reflink(src, dest):
+    with open(src, "rb") as s, open(dest, "wb") as d:
+        fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+    shutil.copystat(src, dest)
+
+
+def replace_with_link(keep, path, mode):
+    """Atomically replace path with a hardlink or reflink of keep."""
+    tmp = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.linking")
+    try:
+        if mode == "hardlink":
+            os.link(keep, tmp)
+        else:
+            reflink(keep, tmp)
+        os.replace(tmp, path)
+    except OSError:
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def link_duplicates(groups, mode="hardlink", dry_run=False):
+    """Link every file of a group to its first path. Returns the bytes saved."""
+    saved = 0
+    for files in groups:
+        files.sort()
+        keep = files[0][0]
+        for path, st in files[1:]:
+            if dry_run:
+                print(f"Would {mode}: {path}\n  to: {keep}")
+            else:
+                try:
+                    replace_with_link(keep, path, mode)
+                except OSError as e:
+                    print(f"SKIP ({e.strerror}): {path}")
+                    continue
+                metrics.count("files_linked")
+            saved += st.st_size
+    return saved
+
+
+def main():
+    start = datetime.datetime.now()
+
+    parser = argparse.ArgumentParser(description="Replace identical files across charts roots with hardlinks or reflinks.")
+    parser.add_argument("--charts", nargs='+', required=True, help="Root BMS charts directories")
+    parser.add_argument("--mode", choices=("hardlink", "reflink"), default="hardlink",
+                        help="hardlinks share one inode (editing one edits all); reflinks need btrfs/XFS")
+    parser.add_argument("--min-size", type=int, default=MIN_SIZE, help="Ignore files smaller than this many bytes")
+    parser.add_argument("--workers", type=int, help="Threads used to hash files")
+    parser.add_argument("--hash-cache", default=CACHE_FILE, help="File caching digests between runs")
+    parser.add_argument("--dry-run", action="store_true", help="Only print what would be linked")
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+    setup_metrics(args)
+
+    cache = HashCache(args.hash_cache)
+    try:
+        groups = find_duplicates(args.charts, cache, args.workers, args.min_size)
+    finally:
+        cache.save()
+    print(f"Digest cache: {cache.hits} hits, {cache.misses} misses")
+
+    with metrics.phase("link"):
+        saved = link_duplicates(groups, args.mode, args.dry_run)
+    metrics.count("bytes_saved", saved)
+    print(f"{'Would save' if args.dry_run else 'Saved'} {saved / 1e6:.1f} MB in {len(groups)} groups of identical files")
+
+    end = datetime.datetime.now()
+    print("Completed in " + str(end - start))
+
+
+if __name__ == "__main__":
+    main()
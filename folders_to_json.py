@@ -1,82 +1,249 @@
-import sqlite3
 import json
+import hashlib
+import os
+import textwrap
 from pathlib import Path
 from collections import defaultdict
 import argparse
 
-def find_containing_child(parent_path, child_path):
-    parent_path = Path(parent_path).resolve()
-    child_path = Path(child_path).resolve()
+from library import Library
+from metrics import add_metrics_arguments, metrics, setup_metrics
+from song_reader import iter_rows
 
-    try:
-        if parent_path not in child_path.parents:
-            return None
-        return child_path.relative_to(parent_path).parts[0]
-    except ValueError:
-        return None
+def make_category_lookup(charts_dirs):
+    """
+    Return a function mapping a song path to [(root index, category)] for every
+    charts root containing it. Roots are resolved once; song paths are only
+    normalized as strings, so the lookup makes no filesystem calls.
+    """
+    roots = defaultdict(list)
+    for i, charts_dir in enumerate(charts_dirs):
+        # song paths may go through a symlinked root or its target, both are looked up
+        for root in {os.path.abspath(charts_dir), str(Path(charts_dir).resolve())}:
+            roots[root].append(i)
 
-def create_table(cursor, charts_dir, flat=False):
-    cursor.execute("""
-        SELECT
-            title,
-            genre,
-            artist,
-            md5,
-            sha256,
-            path,
-            charthash
-        FROM song
-    """)
-
-    charts_path = Path(charts_dir).resolve()
-    table_name = charts_path.name
-    folders = defaultdict(list)
-    seen_hashes = set()
-
-    for title, genre, artist, md5, sha256, path, charthash in cursor.fetchall():
+    cwd = os.getcwd()
+    # song directory → [(root index, category, or None when the song sits in the root itself)]
+    matches_by_dirname = {}
+
+    def find_dir_matches(dirname):
+        directory = os.path.normpath(os.path.join(cwd, dirname))
+        matches = [(i, None) for i in roots.get(directory, ())]
+
+        end = len(directory)
+        while end > 0:
+            sep = directory.rfind(os.sep, 0, end)
+            if sep < 0:
+                break
+            prefix = directory[:sep] or os.sep
+            if prefix in roots:
+                next_sep = directory.find(os.sep, sep + 1)
+                category = directory[sep + 1:next_sep if next_sep >= 0 else len(directory)]
+                matches.extend((i, category) for i in roots[prefix])
+            end = sep
+
+        return matches
+
+    def find_categories(path):
+        dirname, _, name = path.rpartition(os.sep)
+        if os.altsep and os.altsep in name:
+            dirname, name = os.path.split(path)
+
+        matches = matches_by_dirname.get(dirname)
+        if matches is None:
+            matches = matches_by_dirname[dirname] = find_dir_matches(dirname)
+
+        return [(i, category or name) for i, category in matches]
+
+    return find_categories
+
+SONG_COLUMNS = ("title", "genre", "artist", "md5", "sha256", "path", "charthash")
+FOLDER_CLASS = "bms.player.beatoraja.TableData$TableFolder"
+
+def collect_tables(cursor, charts_dirs, flat=False):
+    """
+    Group the songs of every charts root from a single pass over the song table.
+    Returns [(table name, folder name → [(title, genre, artist, md5, sha256, charthash)])].
+    """
+    table_names = [Path(charts_dir).resolve().name for charts_dir in charts_dirs]
+    folders = [defaultdict(list) for _ in charts_dirs]
+    seen_hashes = [set() for _ in charts_dirs]
+    find_categories = make_category_lookup(charts_dirs)
+
+    for title, genre, artist, md5, sha256, path, charthash in iter_rows(cursor, SONG_COLUMNS):
         if not path or not title or not sha256:
             continue
-        if sha256 in seen_hashes:
-            continue
 
-        path = Path(path)
-        category = find_containing_child(charts_path, path)
-        if category is None:
-            continue
+        song = None
+        for i, category in find_categories(path):
+            if sha256 in seen_hashes[i]:
+                continue
+            seen_hashes[i].add(sha256)
 
-        seen_hashes.add(sha256)
-
-        song = {
-            "class": "bms.player.beatoraja.song.SongData",
-            "title": title.strip(),
-            "genre": genre.strip() if genre else "",
-            "artist": artist.strip() if artist else "",
-            "md5": md5,
-            "sha256": sha256,
-            "content": 3,
-            "charthash": charthash
-        }
-
-        if flat:
-            folders[table_name].append(song)
-        else:
-            folders[category].append(song)
-
-    return table_name, {
-        "name": table_name,
-        "folder": [
-            {
-                "class": "bms.player.beatoraja.TableData$TableFolder",
-                "name": folder_name,
-                "songs": songs
-            }
-            for folder_name, songs in sorted(folders.items())
-        ]
+            if song is None:
+                song = (
+                    title.strip(),
+                    genre.strip() if genre else "",
+                    artist.strip() if artist else "",
+                    md5,
+                    sha256,
+                    charthash,
+                )
+
+            if flat:
+                folders[i][table_names[i]].append(song)
+            else:
+                folders[i][category].append(song)
+
+    return list(zip(table_names, folders))
+
+def song_entry(song):
+    title, genre, artist, md5, sha256, charthash = song
+    return {
+        "class": "bms.player.beatoraja.song.SongData",
+        "title": title,
+        "genre": genre,
+        "artist": artist,
+        "md5": md5,
+        "sha256": sha256,
+        "content": 3,
+        "charthash": charthash
     }
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Create beatoraja table JSON")
-    parser.add_argument("--db", required=True, help="Path to song.db")
+def create_tables(cursor, charts_dirs, flat=False):
+    """Build the table of every charts root from a single pass over the song table."""
+    return [
+        (table_name, {
+            "name": table_name,
+            "folder": [
+                {
+                    "class": FOLDER_CLASS,
+                    "name": folder_name,
+                    "songs": [song_entry(song) for song in songs]
+                }
+                for folder_name, songs in sorted(table_folders.items())
+            ]
+        })
+        for table_name, table_folders in collect_tables(cursor, charts_dirs, flat=flat)
+    ]
+
+def create_table(cursor, charts_dir, flat=False):
+    return create_tables(cursor, [charts_dir], flat=flat)[0]
+
+def folder_digest(songs):
+    """Digest of a folder's songs, used to tell which folders changed since the last export."""
+    h = hashlib.blake2b(digest_size=16)
+    for song in songs:
+        h.update("\x1f".join(field or "" for field in song).encode("utf-8"))
+        h.update(b"\x1e")
+    return h.hexdigest()
+
+def encode_folder(folder_name, songs, minify):
+    """Yield the json text of one folder entry, a song at a time."""
+    name = json.dumps(folder_name, ensure_ascii=False)
+
+    if minify:
+        yield f'{{"class":"{FOLDER_CLASS}","name":{name},"songs":['
+        for i, song in enumerate(songs):
+            text = json.dumps(song_entry(song), ensure_ascii=False, separators=(",", ":"))
+            yield f",{text}" if i else text
+        yield "]}"
+        return
+
+    # same layout as json.dump(table, indent=2): folder entries sit 4 spaces deep, songs 8
+    yield f'    {{\n      "class": "{FOLDER_CLASS}",\n      "name": {name},\n      "songs": [\n'
+    for i, song in enumerate(songs):
+        text = textwrap.indent(json.dumps(song_entry(song), indent=2, ensure_ascii=False), " " * 8)
+        yield f",\n{text}" if i else text
+    yield "\n      ]\n    }"
+
+def digests_path(output_path):
+    return Path(f"{output_path}.digests")
+
+def read_digests(output_path, minify):
+    """Return folder name → (digest, offset, length) of the previous export, if it's still intact."""
+    try:
+        with open(digests_path(output_path), encoding="utf-8") as f:
+            previous = json.load(f)
+        st = output_path.stat()
+    except (OSError, ValueError):
+        return {}
+
+    if previous.get("minify") != minify or previous.get("size") != st.st_size or previous.get("mtime_ns") != st.st_mtime_ns:
+        return {}
+    return previous["folders"]
+
+def write_table(output_path, table_name, table_folders, minify=False, incremental=False):
+    """
+    Stream a table to output_path, folder by folder and song by song.
+
+    With incremental, folders whose songs didn't change since the last
+    incremental export are copied byte for byte from the previous file,
+    and the file isn't rewritten at all when nothing changed.
+    Returns (folders written, folders reused), or None when the file was left as is.
+    """
+    output_path = Path(output_path)
+    folder_names = sorted(table_folders)
+    digests = {name: folder_digest(table_folders[name]) for name in folder_names} if incremental else {}
+    previous = read_digests(output_path, minify) if incremental else {}
+
+    reusable = {name for name in folder_names if name in previous and previous[name][0] == digests[name]}
+    if incremental and reusable == set(folder_names) == set(previous):
+        metrics.cache("table_folders", len(reusable), 0)
+        return None
+
+    if minify:
+        head, separator, tail, empty_tail = f'{{"name":{json.dumps(table_name, ensure_ascii=False)},"folder":[', ",", "]}", "]}"
+    else:
+        head = f'{{\n  "name": {json.dumps(table_name, ensure_ascii=False)},\n  "folder": [\n'
+        separator, tail, empty_tail = ",\n", "\n  ]\n}", "]\n}"
+    if not folder_names:
+        head = head.rstrip("\n")
+
+    tmp = output_path.with_name(output_path.name + ".tmp")
+    written_offsets = {}
+    old = open(output_path, "rb") if reusable else None
+
+    try:
+        with open(tmp, "wb") as out:
+            out.write(head.encode("utf-8"))
+
+            for i, name in enumerate(folder_names):
+                if i:
+                    out.write(separator.encode("utf-8"))
+                start = out.tell()
+
+                if name in reusable:
+                    _, offset, length = previous[name]
+                    old.seek(offset)
+                    out.write(old.read(length))
+                else:
+                    for chunk in encode_folder(name, table_folders[name], minify):
+                        out.write(chunk.encode("utf-8"))
+
+                written_offsets[name] = (digests.get(name), start, out.tell() - start)
+
+            out.write((tail if folder_names else empty_tail).encode("utf-8"))
+    finally:
+        if old:
+            old.close()
+
+    os.replace(tmp, output_path)
+
+    if incremental:
+        st = output_path.stat()
+        with open(digests_path(output_path), "w", encoding="utf-8") as f:
+            json.dump({
+                "minify": minify,
+                "size": st.st_size,
+                "mtime_ns": st.st_mtime_ns,
+                "folders": written_offsets,
+            }, f, ensure_ascii=False)
+
+    metrics.cache("table_folders", len(reusable), len(folder_names) - len(reusable))
+    return len(folder_names) - len(reusable), len(reusable)
+
+def add_arguments(parser):
     parser.add_argument("--charts", nargs='+', required=True, help="Root BMS charts directories")
     parser.add_argument("--output", help="Output JSON file (defaults to <chart_dir_name>.json)")
     parser.add_argument(
@@ -84,25 +251,50 @@ if __name__ == "__main__":
         action="store_true",
         help="Put all songs at the root level (no subfolders)"
     )
+    parser.add_argument("--minify", action="store_true", help="Write compact JSON without indentation")
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only rewrite folders whose songs changed since the last export (keeps <table>.json.digests)"
+    )
 
-    args = parser.parse_args()
-
-    conn = sqlite3.connect(args.db)
-    cursor = conn.cursor()
+def run(args, library):
+    """Export the tables from the first song.db of the library."""
+    cursor = library.conn.cursor()
 
-    for charts_dir in args.charts:
-        table_name, table = create_table(cursor, charts_dir, flat=args.flat)
+    with metrics.phase("collect"):
+        tables = collect_tables(cursor, args.charts, flat=args.flat)
 
+    for table_name, table_folders in tables:
         output_path = (
             Path(args.output) / f"{table_name}.json"
             if args.output
             else Path(f"{table_name}.json")
         )
 
-        with open(output_path, "w", encoding="utf-8") as f:
-            json.dump(table, f, indent=2, ensure_ascii=False)
+        with metrics.phase("write"):
+            counts = write_table(
+                output_path, table_name, table_folders, minify=args.minify, incremental=args.incremental
+            )
 
-        print(f"Wrote {output_path}")
+        if counts is None:
+            print(f"Unchanged {output_path}")
+        else:
+            written, reused = counts
+            print(f"Wrote {output_path} ({written} folders written, {reused} reused)")
 
-    conn.close()
+def main():
+    parser = argparse.ArgumentParser(description="Create beatoraja table JSON")
+    parser.add_argument("--db", required=True, help="Path to song.db")
+    add_arguments(parser)
+    add_metrics_arguments(parser)
 
+    args = parser.parse_args()
+    setup_metrics(args)
+
+    # the export only reads song.db, it doesn't need to match the disk
+    with Library([args.db], check=False) as library:
+        run(args, library)
+
+if __name__ == "__main__":
+    main()
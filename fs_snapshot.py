@@ -0,0 +1,93 @@
+"""
+In-memory snapshot of the folders a dedup run looks at.
+
+Folders are grouped by parent and each parent is listed once with
+os.scandir, recording whether each folder exists and its (device, inode).
+Emptiness is read with one scandir per folder, stopping at the first entry.
+After that, exists / samefile / empty questions are answered from memory,
+and the run tells the snapshot about every folder it trashes.
+"""
+import os
+from collections import defaultdict
+
+
+class FsSnapshot:
+    def __init__(self, folders):
+        # Path → (st_dev, st_ino), or None when the folder doesn't exist
+        self.identity = {}
+        # Path → bool, missing when not known yet
+        self.empty = {}
+        # tracked Path → tracked Paths below it
+        self.descendants = defaultdict(list)
+        self.stat_calls = 0
+
+        folders = set(folders)
+        by_parent = defaultdict(dict)
+        for folder in folders:
+            by_parent[folder.parent][folder.name] = folder
+
+        for parent, children in by_parent.items():
+            self._scan_parent(parent, children)
+
+        for folder in folders:
+            for ancestor in folder.parents:
+                if ancestor in folders:
+                    self.descendants[ancestor].append(folder)
+
+    def _scan_parent(self, parent, children):
+        for folder in children.values():
+            self.identity[folder] = None
+
+        try:
+            self.stat_calls += 1
+            with os.scandir(parent) as it:
+                for entry in it:
+                    folder = children.get(entry.name)
+                    if folder is None or not entry.is_dir():
+                        continue
+                    self.stat_calls += 1
+                    st = entry.stat()
+                    self.identity[folder] = (st.st_dev, st.st_ino)
+        except (FileNotFoundError, NotADirectoryError, PermissionError):
+            pass
+
+    def _track(self, folder):
+        """Add a folder that wasn't in the snapshot."""
+        if folder not in self.identity:
+            self._scan_parent(folder.parent, {folder.name: folder})
+
+    def exists(self, folder):
+        self._track(folder)
+        return self.identity[folder] is not None
+
+    def samefile(self, a, b):
+        if a == b:
+            return self.exists(a)
+        self._track(a)
+        self._track(b)
+        return self.identity[a] is not None and self.identity[a] == self.identity[b]
+
+    def is_empty(self, folder):
+        cached = self.empty.get(folder)
+        if cached is not None:
+            return cached
+
+        empty = True
+        if self.exists(folder):
+            self.stat_calls += 1
+            with os.scandir(folder) as it:
+                for _ in it:
+                    empty = False
+                    break
+
+        self.empty[folder] = empty
+        return empty
+
+    def removed(self, folder):
+        """Record that a folder was moved away, with everything below it."""
+        for gone in [folder, *self.descendants.get(folder, ())]:
+            self.identity[gone] = None
+            self.empty[gone] = True
+
+        # the parent may be empty now, look again when asked
+        self.empty.pop(folder.parent, None)
@@ -0,0 +1,223 @@
+"""
+Persistent folder ↔ hash index cache, stored next to song.db as song.db.index.
+
+The cache is used as-is when song.db (and its -wal file) has the same size,
+mtime and inode as when it was written. Otherwise the song table is grouped
+by beatoraja's folder crc (or the directory part of the path) and each group
+gets a checksum: row count and sum of chart dates computed inside SQLite,
+and a digest of the group's sorted (sha256, path) pairs. Only rows of groups
+whose checksum changed are read again. A row whose sha256 or path changed
+(as rehash.py writes them) always changes its group checksum, while a full
+database rebuild that reinserts unchanged charts does not.
+"""
+import hashlib
+import os
+import pickle
+import sqlite3
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from metrics import metrics
+from song_reader import (
+    DIRKEY_SQL, SongIndex, attach_databases, load_duplicate_index, load_index, merge_indexes
+)
+
+CACHE_VERSION = 3
+
+
+def cache_path(db_path):
+    return Path(f"{db_path}.index")
+
+
+def db_stamp(db_path):
+    """Return the size, mtime and inode of song.db and its write-ahead log."""
+    stamp = []
+    for path in (Path(db_path), Path(f"{db_path}-wal")):
+        try:
+            st = path.stat()
+        except FileNotFoundError:
+            stamp.append(None)
+            continue
+        stamp.append((st.st_size, st.st_mtime_ns, st.st_ino))
+    return tuple(stamp)
+
+
+def group_sql(cursor):
+    """Return SQL expressions for the group key and checksum of the song table's rows."""
+    columns = {row[1] for row in cursor.execute("PRAGMA table_info(song)")}
+
+    key = "IFNULL(folder, '')" if "folder" in columns else DIRKEY_SQL
+    # without chart dates, fall back to rowids: deleted and reinserted rows still show up
+    changes = "SUM(date)" if "date" in columns else "SUM(rowid)"
+
+    # the rows are digested by folder_signatures, group_concat order isn't defined
+    rows = "group_concat(IFNULL(sha256, '') || char(30) || IFNULL(path, ''), char(31))"
+    return key, f"COUNT(*), {changes}, {rows}"
+
+
+def rows_digest(rows):
+    """Digest of a group's sha256/path pairs, as joined by group_sql, whatever their order."""
+    h = hashlib.blake2b(digest_size=16)
+    h.update("\x1f".join(sorted((rows or "").split("\x1f"))).encode("utf-8"))
+    return h.hexdigest()
+
+
+def folder_signatures(cursor, key, checksum):
+    """Return group key → checksum tuple for the song table."""
+    cursor.execute(f"SELECT {key} AS groupkey, {checksum} FROM song GROUP BY groupkey")
+    return {groupkey: (*signature, rows_digest(rows)) for groupkey, *signature, rows in cursor}
+
+
+def read_cache(db_path):
+    try:
+        with open(cache_path(db_path), "rb") as f:
+            cache = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ValueError):
+        return None
+
+    if not isinstance(cache, dict) or cache.get("version") != CACHE_VERSION:
+        return None
+    return cache
+
+
+def write_cache(db_path, stamp, key, index, groups):
+    path = cache_path(db_path)
+    tmp = path.with_name(path.name + ".tmp")
+
+    cache = {
+        "version": CACHE_VERSION,
+        "stamp": stamp,
+        "key": key,
+        "index": index.state(),
+        "groups": groups,
+    }
+
+    try:
+        with open(tmp, "wb") as f:
+            pickle.dump(cache, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+    except OSError as e:
+        print(f"Could not write index cache {path}: {e}")
+
+
+def read_changed_rows(cursor, key, groupkeys):
+    """Return group key → [(sha256, path)] for the given group keys."""
+    rows = {groupkey: [] for groupkey in groupkeys}
+    if not rows:
+        return rows
+
+    cursor.execute("CREATE TEMP TABLE changed_groups (groupkey TEXT PRIMARY KEY)")
+    cursor.executemany("INSERT INTO changed_groups VALUES (?)", ((g,) for g in rows))
+
+    cursor.execute(f"""
+        SELECT {key} AS groupkey, sha256, path
+        FROM song
+        WHERE groupkey IN (SELECT groupkey FROM changed_groups)
+    """)
+    for groupkey, sha256, path in cursor:
+        rows[groupkey].append((sha256, path))
+
+    cursor.execute("DROP TABLE changed_groups")
+    return rows
+
+
+def rebuild_index(cursor, cache, key, signatures):
+    """Build a new index, reusing the cached rows of every unchanged group."""
+    old_groups = cache["groups"] if cache else {}
+
+    changed = [
+        groupkey for groupkey, signature in signatures.items()
+        if groupkey not in old_groups or old_groups[groupkey][0] != signature
+    ]
+    fresh_rows = read_changed_rows(cursor, key, changed)
+
+    # keep the cached folder and hash ids so unchanged rows are copied as array slices
+    index = SongIndex.from_state(cache["index"]) if cache else SongIndex()
+    old_folders, old_hashes = index.row_folders, index.row_hashes
+    index.row_folders, index.row_hashes = array("i"), array("i")
+    groups = {}
+
+    for groupkey, signature in signatures.items():
+        start = len(index.row_folders)
+
+        if groupkey in fresh_rows:
+            for sha256, path in fresh_rows[groupkey]:
+                index.add(sha256, path)
+        else:
+            _, old_start, old_end = old_groups[groupkey]
+            index.row_folders.extend(old_folders[old_start:old_end])
+            index.row_hashes.extend(old_hashes[old_start:old_end])
+
+        groups[groupkey] = (signature, start, len(index.row_folders))
+
+    index.compact()
+
+    reused = len(signatures) - len(changed)
+    metrics.cache("index_cache_groups", reused, len(changed))
+    print(f"Index cache: {reused} folder groups reused, {len(changed)} reloaded")
+    return index, groups
+
+
+def load_index_cached(db_path, cursor, use_cache=True):
+    """Return the SongIndex of song.db, using and refreshing the cache next to it."""
+    if not use_cache:
+        return load_index(cursor)
+
+    stamp = db_stamp(db_path)
+    cache = read_cache(db_path)
+
+    if cache and cache["stamp"] == stamp:
+        metrics.cache("index_cache_groups", len(cache["groups"]), 0)
+        return SongIndex.from_state(cache["index"])
+
+    key, checksum = group_sql(cursor)
+    if cache and cache.get("key") != key:
+        cache = None
+
+    signatures = folder_signatures(cursor, key, checksum)
+    index, groups = rebuild_index(cursor, cache, key, signatures)
+    write_cache(db_path, stamp, key, index, groups)
+    return index
+
+
+def load_one_db(db_path, use_cache=True, sql_group=False):
+    conn = sqlite3.connect(db_path)
+    try:
+        if sql_group:
+            return load_duplicate_index(conn.cursor())
+        return load_index_cached(db_path, conn.cursor(), use_cache=use_cache)
+    finally:
+        conn.close()
+
+
+def load_song_dbs(db_paths, use_cache=True, sql_group=False):
+    """
+    Return one SongIndex for one or more song.db files.
+
+    A single database is read as before. Several are combined into one index
+    whose folders are tagged with the databases listing them: each is read
+    (and cached) in its own thread and connection, then merged, or with
+    sql_group they're ATTACHed to one connection so SQLite also finds hashes
+    duplicated across databases. Relative song paths are resolved against the
+    directory of their song.db, where beatoraja runs from.
+    """
+    if len(db_paths) == 1:
+        return load_one_db(db_paths[0], use_cache, sql_group)
+
+    names = [str(db_path) for db_path in db_paths]
+    roots = [Path(db_path).absolute().parent for db_path in db_paths]
+
+    if sql_group:
+        conn = sqlite3.connect(":memory:")
+        try:
+            schemas = attach_databases(conn, db_paths)
+            index = load_duplicate_index(conn.cursor(), schemas=schemas, roots=roots)
+        finally:
+            conn.close()
+        index.origins = names
+        return index
+
+    with ThreadPoolExecutor(max_workers=len(db_paths)) as executor:
+        indexes = list(executor.map(lambda db_path: load_one_db(db_path, use_cache), db_paths))
+    return merge_indexes(indexes, names, roots)
@@ -0,0 +1,124 @@
+"""
+A beatoraja library: one or more song.db files opened once, with the indexes
+the tools share built the first time one of them asks.
+
+Every tool takes a Library in its run(args, library). The scripts make one
+from their own --db, and bms.py keeps a single one for all the subcommands
+of a run, so `bms.py --db song.db subset + export ...` reads song.db once.
+"""
+import sqlite3
+from pathlib import Path
+
+from metrics import metrics
+
+# index_cache, rehash and song_reader are imported where they're first used:
+# a command line that only asks for --help never loads them
+
+
+class Library:
+    def __init__(self, db_paths, use_cache=True, check=True):
+        """
+        use_cache reads and refreshes the song.db.index caches; check makes
+        sure song.db matches the disk before anything is read from it.
+        """
+        self.db_paths = [str(db_path) for db_path in db_paths]
+        self.use_cache = use_cache
+        self.check = check
+        # relative song paths of combined databases are resolved against their own folder
+        self.roots = [None] if len(self.db_paths) == 1 else [Path(db).absolute().parent for db in self.db_paths]
+        self._conns = None
+        self._index = None
+        self._duplicate_index = None
+        self._folders_by_hash = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _open(self):
+        if self._conns is None:
+            if self.check:
+                from rehash import require_fresh
+                require_fresh(self.db_paths)
+            self._conns = [sqlite3.connect(db_path) for db_path in self.db_paths]
+        return self._conns
+
+    @property
+    def conn(self):
+        """Connection to the first song.db."""
+        return self._open()[0]
+
+    def databases(self):
+        """Return [(cursor, root)] of every song.db, root resolving its relative paths (None for one database)."""
+        return [(conn.cursor(), root) for conn, root in zip(self._open(), self.roots)]
+
+    def commit(self):
+        """Commit changes made to the song tables, dropping the indexes built from them."""
+        for conn in self._open():
+            conn.commit()
+        self.invalidate()
+
+    def index(self):
+        """Return the SongIndex of every song row."""
+        if self._index is None:
+            self._open()
+            from index_cache import load_song_dbs
+            with metrics.phase("read_index"):
+                self._index = load_song_dbs(self.db_paths, use_cache=self.use_cache)
+        return self._index
+
+    def duplicate_index(self, sql_group=False):
+        """
+        Return a SongIndex holding at least the rows of hashes in several
+        folders: the full index when it's loaded or sql_group is off,
+        otherwise only those rows, found by SQLite.
+        """
+        if self._index is not None or not sql_group:
+            return self.index()
+        if self._duplicate_index is None:
+            self._open()
+            from index_cache import load_song_dbs
+            with metrics.phase("read_index"):
+                self._duplicate_index = load_song_dbs(self.db_paths, sql_group=True)
+        return self._duplicate_index
+
+    def folders_by_hash(self, sql_group=False):
+        """Return sha256 → folder Paths, only for hashes owned by multiple folders."""
+        if self._folders_by_hash is None:
+            from song_reader import many_folders_by_hash
+            index = self.duplicate_index(sql_group)
+            with metrics.phase("read_index"):
+                self._folders_by_hash = many_folders_by_hash(index)
+        return self._folders_by_hash
+
+    def invalidate(self):
+        self._index = self._duplicate_index = self._folders_by_hash = None
+
+    def reopen(self):
+        """Forget everything read so far, after the charts on disk were changed: song.db is checked again on next use."""
+        self.close()
+        self.invalidate()
+
+    def close(self):
+        if self._conns:
+            for conn in self._conns:
+                conn.close()
+        self._conns = None
+
+
+def add_library_arguments(parser, required=False):
+    parser.add_argument(
+        "--db", nargs="+", required=required,
+        help="Path to song.db, several to combine beatoraja installs sharing chart folders"
+    )
+    parser.add_argument("--no-cache", action="store_true", help="Ignore and don't update the song.db.index cache")
+    parser.add_argument("--skip-check", action="store_true", help="Don't compare song.db with the charts on disk before reading it")
+
+
+def open_library(args):
+    """Return the Library asked for on the command line, or None without --db."""
+    if not args.db:
+        return None
+    return Library(args.db, use_cache=not args.no_cache, check=not args.skip_check)
@@ -1,62 +1,165 @@
-from bs4 import BeautifulSoup
+"""
+Convert event list pages (dt.rowgroup year headers followed by dd.tbody
+tables) to Markdown tables.
+
+Pages are parsed with lxml's iterparse, so every table is turned into rows
+and dropped from the tree as soon as it's closed, and Markdown is written
+while the rest of the page is still being read. Several pages are converted
+in parallel on a process pool.
+"""
+import argparse
+import io
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
+from lxml import etree
+
 HTML_FILE = "input.html"
 OUT_MD = "output.md"
 
+TABLE_HEADER = [
+    "| Event | Organizer | Start | End | Days | Works | Description |",
+    "|------|-----------|-------|-----|------|-------|-------------|",
+]
+
+
 def clean(text):
     return " ".join(text.split())
 
-def parse_html(html):
-    soup = BeautifulSoup(html, "lxml")
-    out = []
 
-    for year_block in soup.select("dt.rowgroup"):
-        year = year_block.get_text(strip=True).split()[0]
+def text_of(element):
+    """Every text below element, without comments, like BeautifulSoup's .text."""
+    return "".join(element.itertext())
+
+
+def has_class(element, name):
+    return name in (element.get("class") or "").split()
+
+
+def table_rows(table):
+    """Yield the Markdown rows of the dl entries directly inside a dd.tbody."""
+    for r in table.iterchildren("dl"):
+        cells = list(r.iterchildren("dt", "dd"))
+        if len(cells) < 7:
+            continue
+
+        # Event (with link)
+        title_tag = cells[0].find(".//a")
+        if title_tag is not None:
+            title = f"[{clean(text_of(title_tag))}]({title_tag.attrib['href']})"
+        else:
+            title = clean(text_of(cells[0]))
+
+        organizer = clean(text_of(cells[1]))
+        start = clean(text_of(cells[2]))
+        end = clean(text_of(cells[3])).lstrip("/")
+        days = clean(text_of(cells[4])).strip("()")
+        works = clean(text_of(cells[5])) or "—"
+
+        # Description: merge <p> tags
+        desc_ps = cells[6].findall(".//p")
+        if desc_ps:
+            desc = "<br>".join(clean(text_of(p)) for p in desc_ps)
+        else:
+            desc = clean(text_of(cells[6])) or "—"
+
+        yield f"| {title} | {organizer} | {start} | {end} | {days} | {works} | {desc} |"
+
 
-        table = year_block.find_next_sibling("dd", class_="tbody")
-        if not table:
+def iter_markdown(source):
+    """
+    Yield the Markdown lines of an event page, read from a path or binary file.
+
+    A year header is kept until the next dd.tbody sibling closes, then the
+    table is converted and cleared along with everything before it.
+    """
+    # dt.rowgroup elements still waiting for their table, with their year
+    pending = []
+
+    for _, element in etree.iterparse(source, events=("end",), tag=("dt", "dd"), html=True, encoding="utf-8"):
+        if element.tag == "dt" and has_class(element, "rowgroup"):
+            year = "".join(s.strip() for s in element.itertext()).split()[0]
+            pending.append((element.getparent(), year))
+            continue
+
+        if element.tag != "dd" or not has_class(element, "tbody"):
             continue
 
-        rows = table.find_all("dl", recursive=False)
+        parent = element.getparent()
+        years = [year for year_parent, year in pending if year_parent is parent]
+        if not years:
+            continue
+        pending = [(year_parent, year) for year_parent, year in pending if year_parent is not parent]
+
+        rows = list(table_rows(element))
+        for year in years:
+            yield f"\n## {year}\n"
+            yield from TABLE_HEADER
+            yield from rows
+
+        # free the table and everything before it, nothing there is needed again
+        element.clear()
+        while element.getprevious() is not None:
+            del parent[0]
+
+
+def write_markdown(lines, out):
+    """Write lines separated by newlines, like "\\n".join(lines)."""
+    first = True
+    for line in lines:
+        out.write(line if first else "\n" + line)
+        first = False
+
+
+def parse_html(html):
+    """Return the Markdown of an event page given as a string."""
+    out = io.StringIO()
+    write_markdown(iter_markdown(io.BytesIO(html.encode("utf-8"))), out)
+    return out.getvalue()
+
+
+def convert(html_path, md_path):
+    """Convert one page, writing Markdown as it's parsed. Returns md_path."""
+    tmp = Path(f"{md_path}.tmp")
+    with open(tmp, "w", encoding="utf-8") as out:
+        write_markdown(iter_markdown(str(html_path)), out)
+    tmp.replace(md_path)
+    return md_path
+
 
-        out.append(f"\n## {year}\n")
-        out.append("| Event | Organizer | Start | End | Days | Works | Description |")
-        out.append("|------|-----------|-------|-----|------|-------|-------------|")
+def output_paths(inputs, output=None, out_dir=None):
+    """Return the Markdown path of every input page."""
+    if output:
+        return [Path(output)]
+    if out_dir:
+        return [Path(out_dir) / Path(p).with_suffix(".md").name for p in inputs]
+    if inputs == [HTML_FILE]:
+        return [Path(OUT_MD)]
+    return [Path(p).with_suffix(".md") for p in inputs]
 
-        for r in rows:
-            cells = r.find_all(["dt", "dd"], recursive=False)
-            if len(cells) < 7:
-                continue
 
-            # Event (with link)
-            title_tag = cells[0].find("a")
-            if title_tag:
-                title = f"[{clean(title_tag.text)}]({title_tag['href']})"
-            else:
-                title = clean(cells[0].text)
+def main():
+    parser = argparse.ArgumentParser(description="Convert event list pages to Markdown tables.")
+    parser.add_argument("inputs", nargs="*", default=[HTML_FILE], help=f"HTML pages to convert (default {HTML_FILE})")
+    parser.add_argument("-o", "--output", help=f"Markdown file, for a single page (default {OUT_MD} for {HTML_FILE}, else next to the page)")
+    parser.add_argument("--out-dir", help="Folder to write <page>.md files to, instead of next to each page")
+    parser.add_argument("--jobs", type=int, help="Pages converted in parallel (default: CPU count)")
+    args = parser.parse_args()
 
-            organizer = clean(cells[1].text)
-            start = clean(cells[2].text)
-            end = clean(cells[3].text).lstrip("/")
-            days = clean(cells[4].text).strip("()")
-            works = clean(cells[5].text) or "—"
+    if args.output and len(args.inputs) > 1:
+        parser.error("--output takes a single page, use --out-dir for several")
+    if args.out_dir:
+        Path(args.out_dir).mkdir(parents=True, exist_ok=True)
 
-            # Description: merge <p> tags
-            desc_ps = cells[6].find_all("p")
-            if desc_ps:
-                desc = "<br>".join(clean(p.text) for p in desc_ps)
-            else:
-                desc = clean(cells[6].text) or "—"
+    outputs = output_paths(args.inputs, args.output, args.out_dir)
+    if len(args.inputs) == 1:
+        print(f"Markdown written to {convert(args.inputs[0], outputs[0])}")
+        return
 
-            out.append(
-                f"| {title} | {organizer} | {start} | {end} | {days} | {works} | {desc} |"
-            )
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        for md_path in pool.map(convert, args.inputs, outputs):
+            print(f"Markdown written to {md_path}")
 
-    return "\n".join(out)
 
 if __name__ == "__main__":
-    html = Path(HTML_FILE).read_text(encoding="utf-8")
-    md = parse_html(html)
-    Path(OUT_MD).write_text(md, encoding="utf-8")
-    print("Markdown written to output.md")
+    main()
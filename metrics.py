@@ -0,0 +1,91 @@
+"""
+Lightweight run metrics shared by the scripts.
+
+Scripts time their phases with `metrics.phase("name")`, library code bumps
+counters with `metrics.count("name", n)` and reports caches with
+`metrics.cache("name", hits, misses)`. Pass --metrics FILE to get them as
+json when the script exits, and --profile FILE for a cProfile dump
+(read it with `python -m pstats FILE`).
+"""
+import atexit
+import cProfile
+import json
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+class Metrics:
+    def __init__(self):
+        self.started = time.time()
+        self._start = time.perf_counter()
+        # phase name → seconds, summed when a phase runs several times
+        self.phases = defaultdict(float)
+        self.counters = defaultdict(int)
+        # cache name → [hits, misses]
+        self.caches = defaultdict(lambda: [0, 0])
+        # counters are also bumped from worker threads
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] += time.perf_counter() - start
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] += n
+
+    def cache(self, name, hits, misses):
+        with self._lock:
+            self.caches[name][0] += hits
+            self.caches[name][1] += misses
+
+    def report(self):
+        return {
+            "argv": sys.argv,
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started)),
+            "total_seconds": round(time.perf_counter() - self._start, 4),
+            "phases": {name: round(seconds, 4) for name, seconds in self.phases.items()},
+            "counters": dict(self.counters),
+            "caches": {
+                name: {"hits": hits, "misses": misses, "hit_rate": round(hits / (hits + misses), 4) if hits + misses else None}
+                for name, (hits, misses) in self.caches.items()
+            },
+        }
+
+    def write(self, path):
+        tmp = f"{path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.report(), f, indent=2)
+        os.replace(tmp, path)
+
+
+metrics = Metrics()
+
+
+def add_metrics_arguments(parser):
+    parser.add_argument("--metrics", help="Write phase timings, counters and cache hit rates to this json file at exit")
+    parser.add_argument("--profile", help="Profile the run with cProfile and dump the stats to this file")
+
+
+def setup_metrics(args):
+    """Start profiling and register the exit hooks asked for on the command line."""
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+        def dump_profile():
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+
+        atexit.register(dump_profile)
+
+    if args.metrics:
+        atexit.register(metrics.write, args.metrics)
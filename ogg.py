@@ -1,21 +1,216 @@
+"""
+Recursively convert .wav keysounds to .ogg, like ogg.sh but resumable.
+
+Every finished file is appended to a manifest, so an interrupted run can be
+started again with the same arguments and only converts what's left. Each
+ogg is encoded to a temporary file next to the wav and renamed into place
+before the wav is deleted, so a crash never leaves a half written .ogg.
+"""
 import argparse
+import json
+import os
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 
+from devices import ROTATIONAL_JOBS, is_rotational
+from metrics import add_metrics_arguments, metrics, setup_metrics
+from progress import Progress
+
+MANIFEST_FILE = "ogg_manifest.jsonl"
+TMP_SUFFIX = ".converting.ogg"
+
+
+def find_wavs(root):
+    """Yield every .wav below root, removing temporary files left by an interrupted run."""
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            if name.endswith(TMP_SUFFIX):
+                os.remove(path)
+            elif name.lower().endswith(".wav"):
+                yield path
+
+
+def default_jobs(root):
+    jobs = os.cpu_count() or 1
+    if is_rotational(root):
+        jobs = min(jobs, ROTATIONAL_JOBS)
+    return jobs
+
+
+class Manifest:
+    """Append-only record of converted and failed wavs, keyed by path, size and mtime."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.entries = {}
+        if self.path.exists():
+            with open(self.path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # last line cut short by an interruption
+                        continue
+                    self.entries[entry["wav"]] = entry
+        self._file = open(self.path, "a", encoding="utf-8")
+
+    def status(self, wav, st):
+        entry = self.entries.get(wav)
+        if entry is None or entry["size"] != st.st_size or entry["mtime_ns"] != st.st_mtime_ns:
+            return None
+        return entry["status"]
+
+    def record(self, wav, size, mtime_ns, status, error=None):
+        entry = {"wav": wav, "size": size, "mtime_ns": mtime_ns, "status": status}
+        if error:
+            entry["error"] = error
+        self.entries[wav] = entry
+        self._file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def encode(wav, tmp, quality):
+    """Encode wav into tmp with oggenc, falling back to ffmpeg. Returns an error message or None."""
+    commands = [
+        ["oggenc", "-Q", "-q", quality, "-o", tmp, wav],
+        ["ffmpeg", "-nostdin", "-loglevel", "error", "-y", "-i", wav, "-c:a", "libvorbis", "-q:a", quality, tmp],
+    ]
+
+    errors = []
+    for command in commands:
+        try:
+            result = subprocess.run(command, stdin=subprocess.DEVNULL, capture_output=True)
+        except FileNotFoundError:
+            errors.append(f"{command[0]} not found")
+            continue
+        if result.returncode == 0:
+            return None
+        errors.append(f"{command[0]}: {result.stderr.decode(errors='replace').strip()}")
+
+    return "; ".join(errors)
+
+
+def convert_file(wav, quality):
+    """Convert one wav and delete it. Returns (input bytes, output bytes, error)."""
+    stem = wav[:-len(".wav")]
+    ogg = stem + ".ogg"
+    tmp = os.path.join(os.path.dirname(wav), "." + os.path.basename(stem) + TMP_SUFFIX)
 
-def convert(root):
-    for child in root.iterdir():
-        if child.is_dir():
-            convert(child)
-        if child.suffix.lower() == ".wav":
-            print(str(child.name))
+    size = os.path.getsize(wav)
+    error = encode(wav, tmp, quality)
+    if error:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        return size, 0, error
+
+    os.replace(tmp, ogg)
+    os.remove(wav)
+    return size, os.path.getsize(ogg), None
+
+
+def convert(root, quality, jobs=None, manifest_file=MANIFEST_FILE, retry_failed=False):
+    """Convert every .wav below root. Returns (converted, failed, skipped)."""
+    jobs = jobs or default_jobs(root)
+    manifest = Manifest(manifest_file)
+
+    todo = []
+    skipped = 0
+    for wav in find_wavs(root):
+        wav = os.path.abspath(wav)
+        st = os.stat(wav)
+        status = manifest.status(wav, st)
+
+        if status == "done":
+            # interrupted between renaming the ogg into place and deleting the wav
+            if os.path.exists(wav[:-len(".wav")] + ".ogg"):
+                os.remove(wav)
+                skipped += 1
+                continue
+        elif status == "failed" and not retry_failed:
+            skipped += 1
+            continue
+
+        todo.append((wav, st))
+
+    total_bytes = sum(st.st_size for _, st in todo)
+    print(f"Converting {len(todo)} files ({total_bytes / 1e6:.1f} MB) with {jobs} jobs, {skipped} skipped")
+
+    converted = failed = 0
+    in_bytes = out_bytes = 0
+    start = time.perf_counter()
+
+    executor = ThreadPoolExecutor(max_workers=jobs)
+    progress = Progress("Converting", total=len(todo))
+    progress.start()
+    try:
+        futures = {executor.submit(convert_file, wav, quality): (wav, st) for wav, st in todo}
+        for future in as_completed(futures):
+            wav, st = futures[future]
+            progress.advance(nbytes=st.st_size)
+            try:
+                size, ogg_size, error = future.result()
+            except OSError as e:
+                size, ogg_size, error = st.st_size, 0, str(e)
+
+            if error:
+                failed += 1
+                metrics.count("files_failed")
+                print(f"ERROR: Failed to convert {wav}: {error}")
+                manifest.record(wav, st.st_size, st.st_mtime_ns, "failed", error)
+                continue
+
+            converted += 1
+            in_bytes += size
+            out_bytes += ogg_size
+            metrics.count("files_converted")
+            metrics.count("bytes_read", size)
+            metrics.count("bytes_written", ogg_size)
+            manifest.record(wav, st.st_size, st.st_mtime_ns, "done")
+    except KeyboardInterrupt:
+        print("Interrupted, run again to continue where this run stopped")
+        executor.shutdown(wait=True, cancel_futures=True)
+        raise
+    finally:
+        executor.shutdown(wait=True)
+        progress.close()
+        manifest.close()
+
+    elapsed = time.perf_counter() - start
+    if elapsed > 0 and converted:
+        print(
+            f"{converted} files in {elapsed:.1f}s: {converted / elapsed:.1f} files/s, "
+            f"{in_bytes / 1e6 / elapsed:.1f} MB/s read, {in_bytes / 1e6:.1f} MB -> {out_bytes / 1e6:.1f} MB"
+        )
+    print(f"Converted {converted}, failed {failed}, skipped {skipped}")
+    return converted, failed, skipped
+
+
+def add_arguments(parser):
+    parser.add_argument("--path", required=True, help="Path to root")
+    parser.add_argument("--q", default="6", help="Encoding quality (default 6, like ogg.sh)")
+    parser.add_argument("--jobs", type=int, help="Concurrent encoders (default: CPU count, 2 on a spinning disk)")
+    parser.add_argument("--manifest", default=MANIFEST_FILE, help="File recording converted and failed files between runs")
+    parser.add_argument("--retry-failed", action="store_true", help="Try again files that failed in an earlier run")
+
+
+def run(args, library=None):
+    """Convert the tree of --path, song.db isn't needed."""
+    return convert(Path(args.path), args.q, jobs=args.jobs, manifest_file=args.manifest, retry_failed=args.retry_failed)
 
 
 def main():
     parser = argparse.ArgumentParser(description="Recursively batch convert .wav to .ogg using oggenc2 and ffmpeg as fallback")
-    parser.add_argument("--path", required=True, help="Path to root")
-    parser.add_argument("--q", required=True, help="Encoding quality")
+    add_arguments(parser)
+    add_metrics_arguments(parser)
     args = parser.parse_args()
-    convert(Path(args.path))
+    setup_metrics(args)
+    run(args)
 
 if __name__ == "__main__":
     main()
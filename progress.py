@@ -0,0 +1,92 @@
+"""
+Progress display for long runs.
+
+Loops only bump counters with `progress.advance()`; a background thread
+renders them at a fixed rate, so the cost per item is an integer addition
+however fast items go by. On a terminal the line is redrawn in place a few
+times per second; otherwise (logs, pipes) a summary line is printed every
+NON_TTY_INTERVAL seconds.
+"""
+import sys
+import threading
+import time
+
+TTY_INTERVAL = 0.2
+NON_TTY_INTERVAL = 10.0
+
+
+def format_bytes(n):
+    for unit in ("B", "KB", "MB", "GB"):
+        if n < 1000:
+            return f"{n:.1f} {unit}"
+        n /= 1000
+    return f"{n:.1f} TB"
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    return f"{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+
+class Progress:
+    def __init__(self, label, total=None, stream=None, interval=None):
+        self.label = label
+        self.total = total
+        self.stream = stream or sys.stderr
+        self.tty = self.stream.isatty()
+        self.interval = interval or (TTY_INTERVAL if self.tty else NON_TTY_INTERVAL)
+        self.done = 0
+        self.bytes = 0
+        self._start = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def start(self):
+        self._start = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def advance(self, n=1, nbytes=0):
+        self.done += n
+        self.bytes += nbytes
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.render()
+
+    def line(self):
+        elapsed = time.perf_counter() - self._start
+        rate = self.done / elapsed if elapsed else 0
+
+        parts = [f"{self.label}: {self.done}"]
+        if self.total:
+            parts[0] += f"/{self.total} ({100 * self.done / self.total:.0f}%)"
+        parts.append(f"{rate:.1f}/s")
+        if self.bytes:
+            parts.append(f"{format_bytes(self.bytes / elapsed if elapsed else 0)}/s")
+        if self.total and rate and self.done < self.total:
+            parts.append(f"ETA {format_duration((self.total - self.done) / rate)}")
+        parts.append(f"elapsed {format_duration(elapsed)}")
+        return ", ".join(parts)
+
+    def render(self, final=False):
+        if self.tty:
+            self.stream.write("\r\x1b[K" + self.line() + ("\n" if final else ""))
+        else:
+            self.stream.write(self.line() + "\n")
+        self.stream.flush()
+
+    def close(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        self.render(final=True)
@@ -0,0 +1,364 @@
+"""
+Bring song.db up to date with the disk without a full beatoraja rebuild.
+
+Every folder song.db knows (plus --root trees, for new folders) is listed
+and each .bms/.bme/.bml/.pms file compared with its row: beatoraja stores
+the file mtime in seconds as `date`, so a different mtime means the chart
+changed. Only changed and new files are read, their md5 and sha256 computed
+on a process pool, and then in batched transactions:
+    changed chart         md5, sha256 and date are updated
+    chart gone            its row is deleted
+    new file, same sha256 as a chart gone (moved by a merge)
+                          the row follows it to its new path, taking the
+                          folder crcs of the charts listed there
+New charts that match no row, or moved to a folder without listed charts
+(whose crcs aren't known), need beatoraja to parse them, they're only
+reported. The dup scripts run the same comparison (without hashing) instead
+of asking whether the database was rebuilt. A passing comparison is recorded
+in song.db.fresh with the mtime of every chart folder; while song.db and
+those folders keep their stamps, the next check only stats the folders.
+Charts edited in place keep their folder's mtime, `rehash.py --check`
+always compares every chart.
+"""
+import argparse
+import datetime
+import hashlib
+import os
+import pickle
+import sqlite3
+import sys
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from index_cache import db_stamp
+from metrics import add_metrics_arguments, metrics, setup_metrics
+from progress import Progress
+from song_reader import iter_rows
+
+CHART_SUFFIXES = (".bms", ".bme", ".bml", ".pms")
+BATCH_SIZE = 1000
+FRESH_VERSION = 1
+
+
+def is_chart(name):
+    return name.lower().endswith(CHART_SUFFIXES)
+
+
+def read_songs(cursor, root):
+    """Return absolute chart path → [stored path, sha256, date, folder crc, parent crc] of the song table."""
+    columns = {row[1] for row in cursor.execute("PRAGMA table_info(song)")}
+    wanted = ["path", "sha256"] + [c for c in ("date", "folder", "parent") if c in columns]
+
+    songs = {}
+    for row in iter_rows(cursor, wanted):
+        values = dict(zip(wanted, row))
+        # relative paths start where beatoraja runs, next to song.db
+        songs[os.path.join(root, values["path"])] = [values["path"], values["sha256"], values.get("date"), values.get("folder"), values.get("parent")]
+    return songs
+
+
+def scan_charts(folders, walk_roots=()):
+    """Return absolute path → stat of every chart file in folders and below walk_roots."""
+    charts = {}
+    folders = set(folders)
+    for walk_root in walk_roots:
+        for dirpath, _, filenames in os.walk(walk_root):
+            if any(is_chart(name) for name in filenames):
+                folders.add(os.path.abspath(dirpath))
+
+    for folder in folders:
+        try:
+            entries = list(os.scandir(folder))
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+        for entry in entries:
+            if is_chart(entry.name) and entry.is_file():
+                charts[entry.path] = entry.stat()
+    metrics.count("charts_scanned", len(charts))
+    return charts
+
+
+def find_changes(songs, charts):
+    """Return (changed, missing, new) absolute paths comparing song rows to charts on disk."""
+    changed = []
+    missing = []
+    for path, (_, _, date, _, _) in songs.items():
+        st = charts.get(path)
+        if st is None:
+            missing.append(path)
+        elif date is None or int(st.st_mtime) != date:
+            changed.append(path)
+    new = [path for path in charts if path not in songs]
+    return changed, missing, new
+
+
+def read_db(db_path):
+    """Return the songs of a song.db, see read_songs."""
+    root = os.path.dirname(os.path.abspath(db_path))
+    conn = sqlite3.connect(db_path)
+    try:
+        return read_songs(conn.cursor(), root)
+    finally:
+        conn.close()
+
+
+def scan_db(db_path, walk_roots=()):
+    """Read a song.db and list its charts on disk. Returns (songs, charts, (changed, missing, new))."""
+    songs = read_db(db_path)
+    charts = scan_charts({os.path.dirname(path) for path in songs}, walk_roots)
+    return songs, charts, find_changes(songs, charts)
+
+
+def fresh_path(db_path):
+    return f"{db_path}.fresh"
+
+
+def folder_mtimes(folders):
+    """Return folder → mtime in ns, None for folders that are gone."""
+    mtimes = {}
+    for folder in folders:
+        try:
+            mtimes[folder] = os.stat(folder).st_mtime_ns
+        except OSError:
+            mtimes[folder] = None
+    return mtimes
+
+
+def read_fresh(db_path):
+    try:
+        with open(fresh_path(db_path), "rb") as f:
+            record = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ValueError):
+        return None
+
+    if not isinstance(record, dict) or record.get("version") != FRESH_VERSION:
+        return None
+    return record
+
+
+def write_fresh(db_path, stamp, mtimes, new):
+    path = fresh_path(db_path)
+    tmp = f"{path}.tmp"
+    record = {"version": FRESH_VERSION, "stamp": stamp, "mtimes": mtimes, "new": new}
+    try:
+        with open(tmp, "wb") as f:
+            pickle.dump(record, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+    except OSError as e:
+        print(f"Could not write {path}: {e}")
+
+
+def check_db(db_path, quick=True):
+    """
+    Return (changed, missing, new) chart paths of a song.db.
+
+    With quick, a check that passed before is trusted while song.db and the
+    mtimes of its chart folders are unchanged. A passing full check is
+    recorded for the next run.
+    """
+    record = read_fresh(db_path) if quick else None
+    if record and record["stamp"] == db_stamp(db_path) and folder_mtimes(record["mtimes"]) == record["mtimes"]:
+        metrics.cache("fresh_check", 1, 0)
+        return [], [], record["new"]
+    metrics.cache("fresh_check", 0, 1)
+
+    # stamps are taken before reading, a change during the scan fails the next quick check
+    stamp = db_stamp(db_path)
+    songs = read_db(db_path)
+    folders = {os.path.dirname(path) for path in songs}
+    mtimes = folder_mtimes(folders)
+    charts = scan_charts(folders)
+    changed, missing, new = find_changes(songs, charts)
+
+    if not changed and not missing:
+        write_fresh(db_path, stamp, mtimes, new)
+    return changed, missing, new
+
+
+def hash_chart(path):
+    """Return (md5, sha256) of a chart file, like beatoraja computes them over its bytes."""
+    with open(path, "rb") as f:
+        data = f.read()
+    return hashlib.md5(data).hexdigest(), hashlib.sha256(data).hexdigest()
+
+
+def hash_chart_safe(path):
+    try:
+        return hash_chart(path)
+    except OSError:
+        return None
+
+
+def hash_charts(paths, workers=None):
+    """Return path → (md5, sha256), or None for files that vanished, hashed on a process pool."""
+    digests = {}
+    if not paths:
+        return digests
+
+    with ProcessPoolExecutor(max_workers=workers) as pool, Progress("Hashing", total=len(paths)) as progress:
+        results = pool.map(hash_chart_safe, paths, chunksize=64)
+        for path, digest in zip(paths, results):
+            digests[path] = digest
+            progress.advance()
+    metrics.count("charts_hashed", len(paths))
+    return digests
+
+
+def plan_updates(songs, charts, changes, digests):
+    """
+    Turn the changes into row updates.
+
+    Returns (updates, moves, deletes, unknown): rows of changed charts, rows
+    following their chart to a new path (with the folder and parent crcs of
+    the folder it moved to), stored paths of rows to delete and absolute
+    paths of new charts beatoraja still has to add. A chart moved to a folder
+    without listed charts is one of those: its crcs can't be copied from
+    another row, so its old row is deleted and beatoraja parses it again.
+    """
+    changed, missing, new = changes
+
+    updates = []
+    for path in changed:
+        digest = digests.get(path)
+        if digest is None:
+            # removed since the scan
+            missing.append(path)
+            continue
+        md5, sha256 = digest
+        updates.append({"md5": md5, "sha256": sha256, "date": int(charts[path].st_mtime), "path": songs[path][0]})
+
+    # a folder's stored directory and crcs, to write moved rows the way beatoraja does
+    folder_rows = {}
+    for path, (stored, _, _, folder, parent) in songs.items():
+        folder_rows.setdefault(os.path.dirname(path), (stored[:len(stored) - len(os.path.basename(path))], folder, parent))
+
+    gone_by_hash = defaultdict(list)
+    for path in missing:
+        gone_by_hash[songs[path][1]].append(path)
+
+    moves = []
+    unknown = []
+    for path in new:
+        digest = digests.get(path)
+        if digest is None:
+            continue
+        md5, sha256 = digest
+        gone = gone_by_hash.get(sha256)
+        destination = folder_rows.get(os.path.dirname(path))
+        if not gone or destination is None:
+            unknown.append(path)
+            continue
+
+        old_stored = songs[gone.pop()][0]
+        prefix, folder, parent = destination
+        moves.append({
+            "new_path": prefix + os.path.basename(path), "folder": folder, "parent": parent,
+            "md5": md5, "sha256": sha256, "date": int(charts[path].st_mtime), "path": old_stored,
+        })
+
+    deletes = [{"path": songs[path][0]} for paths in gone_by_hash.values() for path in paths]
+    return updates, moves, deletes, unknown
+
+
+def write_updates(conn, updates, moves, deletes, batch_size=BATCH_SIZE):
+    """Apply the row changes, committing every batch_size rows."""
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(song)")}
+    # the same columns beatoraja fills, as far as this table has them
+    extra = "".join(f", {c} = :{c}" for c in ("md5", "date") if c in columns)
+    folder = "".join(f", {c} = :{c}" for c in ("folder", "parent") if c in columns)
+
+    statements = (
+        (f"UPDATE song SET sha256 = :sha256{extra} WHERE path = :path", updates),
+        (f"UPDATE song SET path = :new_path, sha256 = :sha256{extra}{folder} WHERE path = :path", moves),
+        ("DELETE FROM song WHERE path = :path", deletes),
+    )
+    for sql, rows in statements:
+        for i in range(0, len(rows), batch_size):
+            with conn:
+                conn.executemany(sql, rows[i:i + batch_size])
+
+
+def rehash(db_path, walk_roots=(), workers=None, dry_run=False):
+    """Update song.db from the disk. Returns (updated, moved, deleted, unknown) counts."""
+    with metrics.phase("scan"):
+        songs, charts, changes = scan_db(db_path, walk_roots)
+    changed, missing, new = changes
+    print(f"{len(songs)} rows, {len(charts)} charts on disk: {len(changed)} changed, {len(missing)} gone, {len(new)} not listed")
+
+    with metrics.phase("hash"):
+        digests = hash_charts(changed + new, workers)
+    updates, moves, deletes, unknown = plan_updates(songs, charts, changes, digests)
+
+    if not dry_run:
+        with metrics.phase("write"):
+            conn = sqlite3.connect(db_path)
+            try:
+                write_updates(conn, updates, moves, deletes)
+            finally:
+                conn.close()
+
+    for path in unknown:
+        print(f"NEW (needs a beatoraja update): {path}")
+    metrics.count("rows_updated", len(updates))
+    metrics.count("rows_moved", len(moves))
+    metrics.count("rows_deleted", len(deletes))
+    return len(updates), len(moves), len(deletes), len(unknown)
+
+
+def require_fresh(db_paths, quick=True):
+    """
+    Exit unless every song.db row matches its chart on disk. Charts missing
+    from song.db are only reported.
+
+    Replaces asking the user whether the database was rebuilt: only names and
+    mtimes are compared, nothing is hashed. quick is passed to check_db.
+    """
+    stale = False
+    for db_path in db_paths:
+        changed, missing, new = check_db(db_path, quick)
+        # rehash can't add charts, only beatoraja can parse them: not a reason to stop
+        if new:
+            print(f"Warning: {len(new)} charts on disk aren't listed in {db_path}, only beatoraja's own update adds them")
+        if changed or missing:
+            stale = True
+            print(f"{db_path} is out of date: {len(changed)} charts changed, {len(missing)} gone")
+
+    if stale:
+        print(f"Update it with: python rehash.py --db {' '.join(map(str, db_paths))} (or skip this check with --skip-check)")
+        sys.exit(1)
+
+
+def main():
+    start = datetime.datetime.now()
+
+    parser = argparse.ArgumentParser(description="Rehash changed charts and update song.db without a full beatoraja rebuild.")
+    parser.add_argument("--db", required=True, nargs="+", help="Path to song.db")
+    parser.add_argument("--root", nargs="+", default=[], help="Also look for charts in new folders below these directories")
+    parser.add_argument("--workers", type=int, help="Processes used to hash charts")
+    parser.add_argument("--dry-run", action="store_true", help="Only print what would change")
+    parser.add_argument("--check", action="store_true", help="Only check whether song.db is up to date, exit status 1 if not")
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+    setup_metrics(args)
+
+    if args.check:
+        require_fresh(args.db, quick=False)
+        print("Up to date")
+        return
+
+    unknown = 0
+    for db_path in args.db:
+        updated, moved, deleted, new = rehash(db_path, [Path(r).absolute() for r in args.root], args.workers, args.dry_run)
+        unknown += new
+        print(f"{db_path}: {'would update' if args.dry_run else 'updated'} {updated}, moved {moved}, deleted {deleted} rows")
+
+    if unknown:
+        print(f"{unknown} new charts need beatoraja's own update to be added")
+
+    end = datetime.datetime.now()
+    print("Completed in " + str(end - start))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+Near-duplicate folders: pairs of folders whose chart sets mostly overlap.
+
+Every folder gets a MinHash signature of NUM_PERM hash functions over its
+chart ids. Signatures are cut into bands, and folders whose band matches
+land in the same bucket (locality-sensitive hashing). Only those candidate
+pairs get an exact Jaccard check, so the work grows with the number of
+charts rather than with the number of folder pairs.
+"""
+import numpy as np
+
+NUM_PERM = 128
+# buckets bigger than this only pair their members with the first one,
+# so a few thousand identical folders don't produce millions of pairs
+MAX_BUCKET = 100
+PRIME = (1 << 31) - 1
+
+
+def lsh_params(threshold, num_perm=NUM_PERM):
+    """
+    Return (bands, rows) with bands * rows == num_perm whose detection curve
+    (1 / bands) ** (1 / rows) sits a little below the threshold, favoring recall.
+    """
+    target = threshold * 0.85
+    options = [(b, num_perm // b) for b in range(1, num_perm + 1) if num_perm % b == 0]
+    return min(options, key=lambda br: abs((1 / br[0]) ** (1 / br[1]) - target))
+
+
+def minhash_signatures(hash_ids, offsets, num_perm=NUM_PERM, seed=0):
+    """
+    Return a (folders, num_perm) uint32 array of MinHash signatures.
+    Folder i holds hash_ids[offsets[i]:offsets[i + 1]], no folder may be empty.
+    """
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, PRIME, size=num_perm, dtype=np.int64)
+    b = rng.integers(0, PRIME, size=num_perm, dtype=np.int64)
+
+    ids = np.asarray(hash_ids, dtype=np.int64)
+    starts = np.asarray(offsets[:-1], dtype=np.int64)
+    signatures = np.empty((len(starts), num_perm), dtype=np.uint32)
+
+    # one permutation at a time keeps memory at one value per row
+    for i in range(num_perm):
+        hashed = (a[i] * ids + b[i]) % PRIME
+        signatures[:, i] = np.minimum.reduceat(hashed, starts)
+    return signatures
+
+
+def candidate_pairs(signatures, bands, rows, seed=0):
+    """Return the set of (i, j), i < j, of folders sharing at least one band."""
+    rng = np.random.default_rng(seed + 1)
+    pairs = set()
+
+    for band in range(bands):
+        # fold the band's rows into one 64-bit key, wrapping on overflow
+        multipliers = rng.integers(1, 1 << 62, size=rows, dtype=np.uint64) | np.uint64(1)
+        block = signatures[:, band * rows:(band + 1) * rows].astype(np.uint64)
+        keys = (block * multipliers).sum(axis=1, dtype=np.uint64)
+
+        order = np.argsort(keys, kind="stable")
+        sorted_keys = keys[order]
+        bounds = np.flatnonzero(sorted_keys[1:] != sorted_keys[:-1]) + 1
+        starts = np.concatenate(([0], bounds))
+        ends = np.concatenate((bounds, [len(keys)]))
+        # most buckets hold a single folder, only walk the others
+        for k in np.flatnonzero(ends - starts > 1).tolist():
+            bucket = sorted(order[starts[k]:ends[k]].tolist())
+            if len(bucket) > MAX_BUCKET:
+                pairs.update((bucket[0], j) for j in bucket[1:])
+                continue
+            for x in range(len(bucket)):
+                for y in range(x + 1, len(bucket)):
+                    pairs.add((bucket[x], bucket[y]))
+
+    return pairs
+
+
+def find_similar_folders(folder_dict, threshold=0.8, num_perm=NUM_PERM, seed=0):
+    """
+    Return [(jaccard, folder_a, folder_b, shared, only_a, only_b)] for folder
+    pairs whose chart sets have a Jaccard similarity of at least threshold,
+    most similar first. shared, only_a and only_b are sets of hashes.
+    """
+    folders = [f for f, hashes in folder_dict.items() if len(hashes)]
+    if len(folders) < 2:
+        return []
+
+    hash_sets = [set(folder_dict[f]) for f in folders]
+    hash_ids = []
+    offsets = [0]
+    for hashes in hash_sets:
+        hash_ids.extend(hashes)
+        offsets.append(len(hash_ids))
+
+    signatures = minhash_signatures(hash_ids, offsets, num_perm, seed)
+    bands, rows = lsh_params(threshold, num_perm)
+
+    similar = []
+    for i, j in candidate_pairs(signatures, bands, rows, seed):
+        a, b = hash_sets[i], hash_sets[j]
+        shared = a & b
+        jaccard = len(shared) / (len(a) + len(b) - len(shared))
+        if jaccard >= threshold:
+            similar.append((jaccard, folders[i], folders[j], shared, a - b, b - a))
+
+    similar.sort(key=lambda s: (-s[0], s[1], s[2]))
+    return similar
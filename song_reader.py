@@ -0,0 +1,333 @@
+"""
+Streaming reader for the beatoraja song table, shared by all the tools.
+
+Folders are interned once as integer ids and sha256 hashes are stored as
+32-byte digests, so the folder ↔ hash relation is kept in flat arrays
+instead of dicts of path and hex strings.
+"""
+import os
+from array import array
+from collections import defaultdict
+from pathlib import Path
+
+CHUNK_SIZE = 10000
+
+# Directory part of song.path, trailing separator included, computed in SQLite
+DIRKEY_SQL = "rtrim(path, replace(replace(path, '/', ''), '\\', ''))"
+
+
+def iter_rows(cursor, columns, chunk_size=CHUNK_SIZE):
+    """Yield rows of the song table in chunks with fetchmany."""
+    cursor.execute(f"SELECT {', '.join(columns)} FROM song")
+
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        yield from rows
+
+
+def hash_key(sha256):
+    """Return the 32-byte digest of a sha256 hex string, or the value itself if it isn't one."""
+    if sha256 and len(sha256) == 64:
+        try:
+            return bytes.fromhex(sha256)
+        except ValueError:
+            pass
+    return sha256
+
+
+def hash_hex(key):
+    """Inverse of hash_key."""
+    return key.hex() if isinstance(key, bytes) else key
+
+
+class Grouping:
+    """Compact key id → sorted distinct value ids, stored as offsets into one array."""
+
+    def __init__(self, keys, values, num_keys):
+        # counting sort of the rows by key, then sort and dedupe each key's slice
+        starts = array("q", bytes(8 * (num_keys + 1)))
+        for k in keys:
+            starts[k + 1] += 1
+        for i in range(num_keys):
+            starts[i + 1] += starts[i]
+
+        slots = array("i", bytes(4 * len(keys)))
+        fill = starts[:-1]
+        for k, v in zip(keys, values):
+            slots[fill[k]] = v
+            fill[k] += 1
+        del fill
+
+        self.values = array("i")
+        self.offsets = array("q", [0])
+        for i in range(num_keys):
+            chunk = slots[starts[i]:starts[i + 1]]
+            if len(chunk) > 1:
+                chunk = sorted(set(chunk))
+            self.values.extend(chunk)
+            self.offsets.append(len(self.values))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, key_id):
+        return self.values[self.offsets[key_id]:self.offsets[key_id + 1]]
+
+    def count(self, key_id):
+        return self.offsets[key_id + 1] - self.offsets[key_id]
+
+    def items(self):
+        for key_id in range(len(self)):
+            yield key_id, self[key_id]
+
+
+def resolve_folder(folder, root=None):
+    """Return folder as seen from root, the directory relative song paths start from."""
+    return folder if root is None else str(Path(root) / folder)
+
+
+def make_folder_lookup(root=None):
+    """Return a function mapping a chart path to its folder string, built once per directory."""
+    folder_by_dirname = {}
+
+    def folder_of(path):
+        dirname, _, name = path.rpartition(os.sep)
+        if os.altsep and os.altsep in name:
+            dirname = os.path.dirname(path)
+
+        folder = folder_by_dirname.get(dirname)
+        if folder is None:
+            folder = folder_by_dirname[dirname] = resolve_folder(str(Path(path).parent), root)
+        return folder
+
+    return folder_of
+
+
+class SongIndex:
+    """Interned folder ↔ hash relation of the song table, one entry per row."""
+
+    def __init__(self):
+        self.folders = []
+        self.folder_ids = {}
+        self.hashes = []
+        self.hash_ids = {}
+        self.row_folders = array("i")
+        self.row_hashes = array("i")
+        # names of the song.db files a combined index was read from, and for
+        # each folder id the ids of the ones listing it (see merge_indexes)
+        self.origins = []
+        self.folder_origins = []
+        self._folder_of = make_folder_lookup()
+
+    def folder_id(self, folder):
+        """Return the id of a folder path string, interning it if new."""
+        folder_id = self.folder_ids.get(folder)
+        if folder_id is None:
+            folder_id = len(self.folders)
+            self.folder_ids[folder] = folder_id
+            self.folders.append(folder)
+        return folder_id
+
+    def hash_id(self, key):
+        """Return the id of a hash key (see hash_key), interning it if new."""
+        hash_id = self.hash_ids.get(key)
+        if hash_id is None:
+            hash_id = len(self.hashes)
+            self.hash_ids[key] = hash_id
+            self.hashes.append(key)
+        return hash_id
+
+    def add(self, sha256, path):
+        """Add one song row."""
+        self.row_folders.append(self.folder_id(self._folder_of(path)))
+        self.row_hashes.append(self.hash_id(hash_key(sha256)))
+
+    def add_folder_hash(self, folder, key):
+        """Add one row given its folder string and hash key."""
+        self.row_folders.append(self.folder_id(folder))
+        self.row_hashes.append(self.hash_id(key))
+
+    def hash_hex(self, hash_id):
+        return hash_hex(self.hashes[hash_id])
+
+    def origin_names(self, folder_id):
+        """Return the names of the databases listing a folder, empty for a single database."""
+        if not self.folder_origins:
+            return []
+        return [self.origins[i] for i in self.folder_origins[folder_id]]
+
+    def state(self):
+        """Return the picklable contents of the index."""
+        return self.folders, self.hashes, self.row_folders, self.row_hashes
+
+    def compact(self):
+        """Drop folders and hashes no row refers to, renumbering the rest."""
+        self.folders, self.row_folders = _compact(self.folders, self.row_folders)
+        self.hashes, self.row_hashes = _compact(self.hashes, self.row_hashes)
+        self.folder_ids = {folder: i for i, folder in enumerate(self.folders)}
+        self.hash_ids = {key: i for i, key in enumerate(self.hashes)}
+
+    @classmethod
+    def from_state(cls, state):
+        index = cls()
+        index.folders, index.hashes, index.row_folders, index.row_hashes = state
+        index.folder_ids = {folder: i for i, folder in enumerate(index.folders)}
+        index.hash_ids = {key: i for i, key in enumerate(index.hashes)}
+        return index
+
+    def folders_by_hash(self):
+        """Return a Grouping of hash id → distinct folder ids."""
+        return Grouping(self.row_hashes, self.row_folders, len(self.hashes))
+
+    def hashes_by_folder(self):
+        """Return a Grouping of folder id → distinct hash ids."""
+        return Grouping(self.row_folders, self.row_hashes, len(self.folders))
+
+
+def _compact(values, rows):
+    used = set(rows)
+    if len(used) == len(values):
+        return values, rows
+
+    remap = [-1] * len(values)
+    kept = []
+    for old_id in sorted(used):
+        remap[old_id] = len(kept)
+        kept.append(values[old_id])
+
+    return kept, array("i", map(remap.__getitem__, rows))
+
+
+def load_index(cursor, chunk_size=CHUNK_SIZE):
+    """Read sha256 and path of every song row into a SongIndex."""
+    index = SongIndex()
+    add = index.add
+
+    for sha256, path in iter_rows(cursor, ("sha256", "path"), chunk_size):
+        add(sha256, path)
+
+    return index
+
+
+def load_duplicate_index(cursor, chunk_size=CHUNK_SIZE, schemas=("main",), roots=None):
+    """
+    Return a SongIndex of only the rows whose hash is in more than one folder.
+
+    SQLite finds those hashes with GROUP BY ... HAVING into an indexed temp
+    table, grouping on beatoraja's folder crc when the table has one, and
+    derives each remaining row's directory with string functions, so Python
+    never sees the rows of charts that exist only once.
+
+    With several schemas (song.db files ATTACHed to the connection, see
+    attach_databases) their song tables are grouped together, so hashes
+    duplicated across databases are found too. Their folders are resolved
+    against roots and tagged with their origin like merge_indexes does.
+    """
+    multiple = len(schemas) > 1
+    roots = roots or [None] * len(schemas)
+
+    sources = []
+    for origin_id, schema in enumerate(schemas):
+        columns = {row[1] for row in cursor.execute(f"PRAGMA {schema}.table_info(song)")}
+        group = "IFNULL(folder, '')" if "folder" in columns else DIRKEY_SQL
+        if multiple:
+            # the same folder crc means nothing across installs
+            group = f"'{origin_id}:' || {group}"
+        sources.append(f"SELECT sha256, path, {origin_id} AS origin, {group} AS groupkey FROM {schema}.song")
+
+    cursor.execute("DROP VIEW IF EXISTS temp.all_songs")
+    cursor.execute("CREATE TEMP VIEW all_songs AS " + " UNION ALL ".join(sources))
+    cursor.execute("DROP TABLE IF EXISTS temp.dup_hashes")
+    cursor.execute("CREATE TEMP TABLE dup_hashes (sha256 TEXT PRIMARY KEY) WITHOUT ROWID")
+    cursor.execute("""
+        INSERT INTO dup_hashes
+        SELECT sha256 FROM all_songs
+        WHERE sha256 IS NOT NULL
+        GROUP BY sha256
+        HAVING COUNT(DISTINCT groupkey) > 1
+    """)
+    cursor.execute(f"SELECT sha256, origin, {DIRKEY_SQL} FROM all_songs WHERE sha256 IN dup_hashes")
+
+    index = SongIndex()
+    # (origin, directory with trailing separator) → folder string, as str(Path(path).parent) gives it
+    folders = {}
+    folder_origins = defaultdict(set)
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        for sha256, origin, dirkey in rows:
+            folder = folders.get((origin, dirkey))
+            if folder is None:
+                folder = folders[origin, dirkey] = resolve_folder(str(Path(dirkey or ".")), roots[origin])
+            index.add_folder_hash(folder, hash_key(sha256))
+            if multiple:
+                folder_origins[index.row_folders[-1]].add(origin)
+
+    cursor.execute("DROP TABLE temp.dup_hashes")
+    cursor.execute("DROP VIEW temp.all_songs")
+
+    if multiple:
+        index.origins = list(schemas)
+        index.folder_origins = [tuple(sorted(folder_origins[i])) for i in range(len(index.folders))]
+    return index
+
+
+def attach_databases(conn, db_paths):
+    """ATTACH every song.db to conn, returning their schema names."""
+    schemas = []
+    for i, db_path in enumerate(db_paths):
+        schema = f"db{i}"
+        conn.execute(f"ATTACH DATABASE ? AS {schema}", (str(db_path),))
+        schemas.append(schema)
+    return schemas
+
+
+def merge_indexes(indexes, origins, roots):
+    """
+    Combine the SongIndexes of several song.db files into one.
+
+    Relative folders of indexes[i] are resolved against roots[i], so the same
+    chart folder listed by two installs becomes one folder. The result's
+    origins are the given names, and folder_origins[folder_id] the sorted ids
+    of the databases listing each folder.
+    """
+    combined = SongIndex()
+    folder_origins = defaultdict(set)
+
+    for origin_id, (index, root) in enumerate(zip(indexes, roots)):
+        folder_map = array("i", (combined.folder_id(resolve_folder(f, root)) for f in index.folders))
+        hash_map = array("i", map(combined.hash_id, index.hashes))
+        for folder_id in folder_map:
+            folder_origins[folder_id].add(origin_id)
+
+        combined.row_folders.extend(map(folder_map.__getitem__, index.row_folders))
+        combined.row_hashes.extend(map(hash_map.__getitem__, index.row_hashes))
+
+    combined.origins = list(origins)
+    combined.folder_origins = [tuple(sorted(folder_origins[i])) for i in range(len(combined.folders))]
+    return combined
+
+
+def many_folders_by_hash(index):
+    """Return a mapping of sha256 → folder Paths, only for hashes owned by multiple folders."""
+    folders_by_hash = index.folders_by_hash()
+    paths = {}
+    result = {}
+
+    for hash_id in range(len(folders_by_hash)):
+        if folders_by_hash.count(hash_id) < 2:
+            continue
+
+        folders = []
+        for folder_id in folders_by_hash[hash_id]:
+            path = paths.get(folder_id)
+            if path is None:
+                path = paths[folder_id] = Path(index.folders[folder_id])
+            folders.append(path)
+
+        result[index.hash_hex(hash_id)] = folders
+
+    return result
@@ -0,0 +1,28 @@
+import numpy as np
+import soundfile as sf
+
+from audio_check import AudioChecker
+from audio_pairs import resolve_audio_pairs
+from trash import Trash
+
+
+def test_keeps_preferred_format_unless_corrupt(tmp_path):
+    song = tmp_path / "charts" / "song"
+    song.mkdir(parents=True)
+    tone = np.zeros((4410, 1), dtype="float32")
+    for stem in ("kick", "snare"):
+        sf.write(song / f"{stem}.wav", tone, 44100)
+        sf.write(song / f"{stem}.ogg", tone, 44100)
+    sf.write(song / "hat.wav", tone, 44100)
+    # snare.ogg cut short, so the wav is kept instead
+    data = (song / "snare.ogg").read_bytes()
+    (song / "snare.ogg").write_bytes(data[:len(data) // 2])
+
+    trash = Trash(root=tmp_path / "trash", journal_dir=tmp_path / "trash")
+    checker = AudioChecker(cache_file=None, deep=True)
+    resolve_audio_pairs(tmp_path / "charts", ".ogg", checker, trash)
+    checker.close()
+    trash.close()
+
+    assert sorted(f.name for f in song.iterdir()) == ["hat.wav", "kick.ogg", "snare.wav"]
+    assert trash.moved == 2
@@ -0,0 +1,13 @@
+import dup_search_v3
+
+
+def test_a_trashed_priority_folder_keeps_the_other_copies(tmp_path):
+    x, y, w = tmp_path / "a" / "X", tmp_path / "Y", tmp_path / "a" / "b" / "W"
+    for folder in (x, y, w):
+        folder.mkdir(parents=True)
+        (folder / "1.bms").write_text(folder.name)
+
+    # X loses to Y for h1, then is the shortest path holding h2
+    plan = dup_search_v3.plan_deduplication({"h1": [x, y], "h2": [x, w]}, [], [])
+
+    assert [op[1] for op in plan.ops] == [str(x)]
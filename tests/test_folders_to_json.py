@@ -0,0 +1,18 @@
+import sqlite3
+
+import folders_to_json
+
+
+def test_symlinked_root_matches_its_song_paths(tmp_path, monkeypatch):
+    (tmp_path / "real" / "BMS" / "p1").mkdir(parents=True)
+    (tmp_path / "link").symlink_to(tmp_path / "real" / "BMS")
+    monkeypatch.chdir(tmp_path)
+
+    conn = sqlite3.connect(":memory:")
+    conn.execute("CREATE TABLE song (title TEXT, genre TEXT, artist TEXT, md5 TEXT, sha256 TEXT, path TEXT, charthash TEXT)")
+    conn.execute("INSERT INTO song VALUES ('x', '', '', 'm1', 'h1', 'link/p1/x.bms', 'c1')")
+    conn.execute("INSERT INTO song VALUES ('y', '', '', 'm2', 'h2', 'real/BMS/p1/y.bms', 'c2')")
+
+    [(table_name, folders)] = folders_to_json.collect_tables(conn.cursor(), ["link"])
+    assert table_name == "BMS"
+    assert sorted(song[0] for song in folders["p1"]) == ["x", "y"]
@@ -0,0 +1,51 @@
+import sqlite3
+
+from index_cache import load_index_cached
+from song_reader import load_index
+
+ROWS = [
+    ("aa" * 32, "packs/x/1.bms", "x", 1),
+    ("bb" * 32, "packs/x/2.bms", "x", 2),
+    ("cc" * 32, "packs/y/1.bms", "y", 3),
+]
+
+
+def contents(index):
+    return sorted((index.folders[f], index.hashes[h]) for f, h in zip(index.row_folders, index.row_hashes))
+
+
+def check(db_path, conn):
+    cached = load_index_cached(db_path, conn.cursor())
+    assert contents(cached) == contents(load_index(conn.cursor()))
+
+
+def test_cache_follows_changed_rows(tmp_path, capsys):
+    db_path = tmp_path / "song.db"
+    conn = sqlite3.connect(db_path)
+    conn.execute("CREATE TABLE song (sha256 TEXT, path TEXT, folder TEXT, date INTEGER)")
+    conn.executemany("INSERT INTO song VALUES (?, ?, ?, ?)", ROWS)
+    conn.commit()
+    check(db_path, conn)
+
+    # a full rebuild reinserting the same charts reuses every group
+    conn.execute("DELETE FROM song")
+    conn.executemany("INSERT INTO song VALUES (?, ?, ?, ?)", reversed(ROWS))
+    conn.commit()
+    capsys.readouterr()
+    check(db_path, conn)
+    assert "2 folder groups reused, 0 reloaded" in capsys.readouterr().out
+
+    # same date and first digit, only the rest of the sha256 differs
+    conn.execute("UPDATE song SET sha256 = ? WHERE path = 'packs/x/2.bms'", ("b" + "d" * 63,))
+    conn.commit()
+    check(db_path, conn)
+
+    # a chart moved to another directory, its folder crc unchanged
+    conn.execute("UPDATE song SET path = 'packs/z/1.bms' WHERE path = 'packs/y/1.bms'")
+    conn.commit()
+    check(db_path, conn)
+
+    conn.execute("DELETE FROM song WHERE path = 'packs/z/1.bms'")
+    conn.commit()
+    check(db_path, conn)
+    conn.close()
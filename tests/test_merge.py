@@ -0,0 +1,172 @@
+import json
+import os
+from pathlib import Path
+
+import pytest
+
+import dup_search_v2
+import dedup_plan
+from dedup_plan import Plan, apply_plan, merge_units
+from trash import Trash
+
+FIXTURES = sorted(Path(__file__).parent.glob("merge*.json"))
+
+
+def build_library(root, files_by_hash):
+    """Create every listed file and return hash → folders, like song_reader.many_folders_by_hash."""
+    folders_by_hash = {}
+
+    for sha256, files in files_by_hash.items():
+        folders = []
+        for file in files:
+            path = root / file
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(file)
+            if path.parent not in folders:
+                folders.append(path.parent)
+
+        if len(folders) > 1:
+            folders_by_hash[sha256] = folders
+
+    return folders_by_hash
+
+
+@pytest.mark.parametrize("fixture", FIXTURES, ids=[f.stem for f in FIXTURES])
+def test_merge_in_one_pass(fixture, tmp_path, monkeypatch):
+    scenario = json.loads(fixture.read_text())
+    library = tmp_path / "library"
+    monkeypatch.chdir(tmp_path)
+
+    folders_by_hash = build_library(library, scenario["files_by_hash"])
+    priorities = [library / p for p in scenario["priority_list"]]
+
+    trash = Trash(root=tmp_path / "trash", journal_dir=tmp_path / "trash")
+    dup_search_v2.run_deduplication(folders_by_hash, priorities, [], trash=trash)
+    trash.close()
+
+    for folder, expected in scenario["expected"].items():
+        folder = library / folder
+        files = sorted(p.name for p in folder.iterdir()) if folder.exists() else []
+        assert files == sorted(expected), folder
+
+
+def test_chained_overlaps_form_one_component(tmp_path):
+    a, b, c, d = (tmp_path / name for name in "abcd")
+    folders_by_hash = {"h1": [a, b], "h2": [b, c], "h3": [c, d]}
+
+    components = dup_search_v2.find_merge_components(folders_by_hash)
+
+    assert len(components) == 1
+    assert sorted(components[0]) == [a, b, c, d]
+
+
+def test_components_ignore_row_order(tmp_path):
+    a, b, c, d = (tmp_path / name for name in "abcd")
+
+    forward = dup_search_v2.find_merge_components({"h1": [a, b], "h2": [c, d], "h3": [d, b]})
+    backward = dup_search_v2.find_merge_components({"h3": [b, d], "h2": [d, c], "h1": [b, a]})
+
+    assert forward == backward == [[a, b, c, d]]
+
+
+def test_nested_merges_share_a_unit(tmp_path):
+    plan = Plan("v2")
+    plan.merge(tmp_path / "a", tmp_path / "b")
+    plan.trash(tmp_path / "a" / "1.bms", "already in destination")
+    plan.merge(tmp_path / "c", tmp_path / "d")
+    plan.merge(tmp_path / "e", tmp_path / "b" / "sub")
+
+    units = merge_units(plan)
+
+    assert [ops for _, ops in units] == [[0, 1, 3], [2]]
+
+
+def test_planning_leaves_files_alone_and_apply_resumes(tmp_path, monkeypatch):
+    scenario = json.loads((Path(__file__).parent / "merge_chain.json").read_text())
+    library = tmp_path / "library"
+    monkeypatch.chdir(tmp_path)
+
+    folders_by_hash = build_library(library, scenario["files_by_hash"])
+    priorities = [library / p for p in scenario["priority_list"]]
+    before = sorted(p.relative_to(library) for p in library.rglob("*"))
+
+    checker = dup_search_v2.AudioChecker(cache_file=None)
+    plan = dup_search_v2.plan_deduplication(folders_by_hash, priorities, [], checker)
+    assert sorted(p.relative_to(library) for p in library.rglob("*")) == before
+
+    plan_path = plan.save(tmp_path / "run.plan.gz")
+    plan = Plan.load(plan_path)
+    trash = Trash(root=tmp_path / "trash", journal_dir=tmp_path / "trash")
+
+    # stop after the first operation, as if the run was interrupted
+    first = Plan(plan.tool, plan.ops[:1])
+    apply_plan(first, trash, plan_path)
+    apply_plan(plan, trash, plan_path)
+    trash.close()
+
+    assert sorted(p.name for p in (library / "Priority_1").iterdir()) == scenario["expected"]["Priority_1"]
+
+
+@pytest.mark.parametrize("started", [True, False], ids=["started", "not_started"])
+def test_resume_finishes_only_a_folder_it_copied_halfway(tmp_path, monkeypatch, started):
+    src, dest = tmp_path / "a" / "song", tmp_path / "b" / "song"
+    for name in ("1.bms", "kick.wav"):
+        (src / name).parent.mkdir(parents=True, exist_ok=True)
+        (src / name).write_text(name)
+    # shutil.move to another disk stopped after copying one file,
+    # or a folder of that name was there before the run
+    dest.mkdir(parents=True)
+    (dest / "1.bms").write_text("1.bms")
+
+    plan = Plan("v2")
+    plan.move(src, dest)
+    plan.move(tmp_path / "a" / "gone.bms", tmp_path / "b" / "gone.bms")
+    plan.trash(tmp_path / "a", "emptied by the merge")
+    plan_path = plan.save(tmp_path / "run.plan.gz")
+    if started:
+        dedup_plan.progress_path(plan_path).write_text("s0\n")
+
+    trash = Trash(root=tmp_path / "trash", journal_dir=tmp_path / "trash")
+    monkeypatch.setattr(dedup_plan, "device_of", lambda path: "b" if tmp_path / "b" in Path(path).parents else "a")
+    apply_plan(plan, trash, plan_path)
+    trash.close()
+
+    # the missing file and an existing destination are skipped, the rest still runs
+    assert not (tmp_path / "a").exists()
+    assert sorted(p.name for p in dest.iterdir()) == (["1.bms", "kick.wav"] if started else ["1.bms"])
+
+
+def test_unwritable_destination_is_skipped(tmp_path, monkeypatch):
+    for name in ("a", "c"):
+        (tmp_path / name).mkdir()
+        (tmp_path / name / "1.bms").write_text(name)
+
+    plan = Plan("v2")
+    plan.merge(tmp_path / "a", tmp_path / "b")
+    plan.move(tmp_path / "a" / "1.bms", tmp_path / "b" / "new" / "1.bms")
+    plan.merge(tmp_path / "c", tmp_path / "d")
+    plan.move(tmp_path / "c" / "1.bms", tmp_path / "d" / "1.bms")
+
+    makedirs = os.makedirs
+
+    def read_only_b(path, exist_ok=False):
+        if str(tmp_path / "b") in str(path):
+            raise PermissionError(path)
+        makedirs(path, exist_ok=exist_ok)
+
+    monkeypatch.setattr(dedup_plan.os, "makedirs", read_only_b)
+    trash = Trash(root=tmp_path / "trash", journal_dir=tmp_path / "trash")
+    dedup_plan.apply_plan_parallel(plan, trash)
+    trash.close()
+
+    assert (tmp_path / "a" / "1.bms").exists()
+    assert (tmp_path / "d" / "1.bms").read_text() == "c"
+
+
+def test_merge_roots_are_the_outermost_destination_parents(tmp_path):
+    plan = Plan("v2")
+    plan.merge(tmp_path / "old" / "a", tmp_path / "BMS" / "pack" / "song")
+    plan.merge(tmp_path / "old" / "b", tmp_path / "BMS" / "pack" / "song" / "sub")
+    plan.merge(tmp_path / "old" / "c", tmp_path / "PMS" / "other")
+
+    assert dedup_plan.merge_roots(plan) == [tmp_path / "BMS" / "pack", tmp_path / "PMS"]
@@ -0,0 +1,64 @@
+import hashlib
+import os
+import sqlite3
+
+import rehash
+
+
+def add_chart(conn, db_root, path, content):
+    full = db_root / path
+    full.parent.mkdir(parents=True, exist_ok=True)
+    full.write_bytes(content)
+    conn.execute(
+        "INSERT INTO song VALUES (?, ?, ?, ?, ?, ?)",
+        (
+            hashlib.md5(content).hexdigest(), hashlib.sha256(content).hexdigest(), path,
+            f"crc {full.parent.name}", f"crc {full.parent.parent.name}", int(full.stat().st_mtime),
+        ),
+    )
+
+
+def test_rows_follow_the_disk(tmp_path):
+    db = tmp_path / "song.db"
+    conn = sqlite3.connect(db)
+    conn.execute("CREATE TABLE song (md5 TEXT, sha256 TEXT, path TEXT PRIMARY KEY, folder TEXT, parent TEXT, date INTEGER)")
+    add_chart(conn, tmp_path, "BMS/a/moved.bms", b"moved")
+    add_chart(conn, tmp_path, "BMS/a/edited.bme", b"before")
+    add_chart(conn, tmp_path, "BMS/a/gone.bml", b"gone")
+    add_chart(conn, tmp_path, "BMS/a/lonely.bms", b"lonely")
+    add_chart(conn, tmp_path, "Packs/b/kept.bms", b"kept")
+    conn.commit()
+    conn.close()
+
+    # what a merge of a into b, in another root, and an edit leave behind
+    os.replace(tmp_path / "BMS/a/moved.bms", tmp_path / "Packs/b/moved.bms")
+    # no crcs to copy in a folder song.db doesn't list, beatoraja has to add it again
+    (tmp_path / "Packs/c").mkdir()
+    os.replace(tmp_path / "BMS/a/lonely.bms", tmp_path / "Packs/c/lonely.bms")
+    (tmp_path / "BMS/a/gone.bml").unlink()
+    (tmp_path / "BMS/a/edited.bme").write_bytes(b"after")
+    os.utime(tmp_path / "BMS/a/edited.bme", (1, 1))
+    (tmp_path / "Packs/b/unknown.pms").write_bytes(b"unknown")
+
+    assert rehash.rehash(db, walk_roots=[tmp_path / "Packs"], workers=1) == (1, 1, 2, 2)
+
+    conn = sqlite3.connect(db)
+    rows = {
+        path: (sha256, folder, parent, date)
+        for sha256, path, folder, parent, date in conn.execute("SELECT sha256, path, folder, parent, date FROM song")
+    }
+    conn.close()
+
+    assert sorted(rows) == ["BMS/a/edited.bme", "Packs/b/kept.bms", "Packs/b/moved.bms"]
+    assert rows["BMS/a/edited.bme"][::3] == (hashlib.sha256(b"after").hexdigest(), 1)
+    assert rows["Packs/b/moved.bms"][1:3] == ("crc b", "crc Packs")
+
+    _, _, changes = rehash.scan_db(db)
+    assert changes == ([], [], [str(tmp_path / "Packs/b/unknown.pms")])
+    # the unknown chart is only a warning, the rows all match the disk
+    rehash.require_fresh([db])
+
+    # the passing check was recorded: removing a chart changes its folder's mtime
+    assert rehash.read_fresh(db) is not None
+    (tmp_path / "Packs/b/kept.bms").unlink()
+    assert rehash.check_db(db)[1] == [str(tmp_path / "Packs/b/kept.bms")]
@@ -0,0 +1,52 @@
+import sqlite3
+
+import pytest
+
+from index_cache import load_song_dbs
+from song_reader import many_folders_by_hash
+
+SHARED = "aa" * 32
+ONLY_A = "bb" * 32
+
+
+def write_db(db_path, rows):
+    conn = sqlite3.connect(db_path)
+    conn.execute("CREATE TABLE song (sha256 TEXT, path TEXT)")
+    conn.executemany("INSERT INTO song VALUES (?, ?)", rows)
+    conn.commit()
+    conn.close()
+
+
+@pytest.mark.parametrize("sql_group", [False, True], ids=["cached", "sql_group"])
+def test_duplicates_across_databases(tmp_path, sql_group):
+    # each install lists a chart once, only together is it a duplicate
+    write_db(tmp_path / "a.db", [(SHARED, "packs/x/1.bms"), (ONLY_A, "packs/x/2.bms")])
+    (tmp_path / "b").mkdir()
+    write_db(tmp_path / "b" / "b.db", [(SHARED, "packs/y/1.bms"), (ONLY_A, str(tmp_path / "packs" / "x" / "2.bms"))])
+
+    index = load_song_dbs([tmp_path / "a.db", tmp_path / "b" / "b.db"], use_cache=False, sql_group=sql_group)
+
+    x, y = str(tmp_path / "packs" / "x"), str(tmp_path / "b" / "packs" / "y")
+    assert {sha256: sorted(map(str, folders)) for sha256, folders in many_folders_by_hash(index).items()} == {
+        SHARED: sorted([x, y]),
+    }
+    # the absolute path of b.db points into a's folder, which is tagged with both
+    assert index.origin_names(index.folder_ids[y]) == [str(tmp_path / "b" / "b.db")]
+    assert len(index.origin_names(index.folder_ids[x])) == 2
+
+
+def test_chained_commands_read_the_index_once(tmp_path, monkeypatch):
+    import bms
+    import index_cache
+
+    write_db(tmp_path / "a.db", [(SHARED, "packs/x/1.bms"), (SHARED, "packs/y/1.bms"), (ONLY_A, "packs/y/2.bms")])
+    loads = []
+    load = index_cache.load_song_dbs
+    monkeypatch.setattr(index_cache, "load_song_dbs", lambda *args, **kwargs: loads.append(args) or load(*args, **kwargs))
+    monkeypatch.chdir(tmp_path)
+
+    db = str(tmp_path / "a.db")
+    bms.main(["--db", db, "--no-cache", "--skip-check", "subset", "+", "merge", "--plan-out", "plan.gz"])
+
+    assert len(loads) == 1
+    assert (tmp_path / "plan.gz").exists()
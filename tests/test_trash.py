@@ -0,0 +1,81 @@
+import errno
+from pathlib import Path
+
+import trash as trash_module
+from trash import Trash, undo
+
+
+def test_undo_restores_trashed_paths(tmp_path):
+    song = tmp_path / "charts" / "song"
+    song.mkdir(parents=True)
+    (song / "a.bms").write_text("a")
+    keysound = tmp_path / "charts" / "other" / "kick.wav"
+    keysound.parent.mkdir()
+    keysound.write_text("kick")
+
+    trash = Trash(journal_dir=tmp_path / "journals")
+    # without an explicit root the trash lives on the source's filesystem
+    trash._trash_base = lambda folder: tmp_path
+    assert trash.move(song)
+    assert trash.move(keysound)
+    assert trash.move(tmp_path / "missing")
+    trash.close()
+
+    assert not song.exists() and not keysound.exists()
+    assert (tmp_path / ".bms-trash" / trash.run_id / "charts" / "song" / "a.bms").exists()
+
+    assert undo(trash.journal_path) == 2
+    assert (song / "a.bms").read_text() == "a"
+    assert keysound.read_text() == "kick"
+    assert not trash.journal_path.exists()
+
+
+def test_undo_reverses_moves_in_order(tmp_path):
+    trash = Trash(root=tmp_path / "trash", journal_dir=tmp_path / "trash")
+    target = tmp_path / "dest" / "kick.wav"
+    incoming = tmp_path / "src" / "kick.wav"
+    target.parent.mkdir()
+    incoming.parent.mkdir()
+    target.write_text("first")
+    incoming.write_text("second")
+
+    # a merge trashes the old file, moves the new one in, then trashes that too
+    assert trash.move(target)
+    incoming.rename(target)
+    trash.record(incoming, target, "move")
+    assert trash.move(target)
+    trash.close()
+
+    undo(trash.journal_path)
+    assert target.read_text() == "first"
+    assert incoming.read_text() == "second"
+
+
+def test_reserved_names_are_not_handed_out_twice(tmp_path):
+    trash = Trash(root=tmp_path / "trash", journal_dir=tmp_path / "trash")
+    song = tmp_path / "charts" / "song"
+
+    # another thread is still copying a folder of the same name to the trash
+    first = trash.destination(song)
+    trash.reserved.add(first)
+
+    assert trash.destination(song) == first.with_name("song.1")
+
+
+def test_read_only_mount_point_is_passed_over(tmp_path, monkeypatch):
+    read_only = tmp_path / "mnt"
+    song = read_only / "charts" / "song"
+    song.mkdir(parents=True)
+    monkeypatch.setattr(trash_module, "same_device_ancestors", lambda folder: (0, [read_only, read_only / "charts"]))
+
+    mkdir = Path.mkdir
+
+    def read_only_mkdir(path, *args, **kwargs):
+        if path == read_only / trash_module.TRASH_DIR:
+            raise OSError(errno.EROFS, "Read-only file system", str(path))
+        return mkdir(path, *args, **kwargs)
+
+    monkeypatch.setattr(Path, "mkdir", read_only_mkdir)
+    trash = Trash(journal_dir=tmp_path / "journals")
+
+    assert trash._trash_base(song.parent) == read_only / "charts"
@@ -0,0 +1,195 @@
+"""
+Journaled trash shared by dup_search_v2 and dup_search_v3.
+
+Each trashed path is renamed into a .bms-trash folder on the same
+filesystem as the source, so trashing a folder is a single os.rename
+instead of a byte copy. Every trash move, and every other move a run
+records (like v2 merging files into another folder), is appended to a
+journal in ./trash, and `python trash.py undo <journal>` replays it in
+reverse.
+"""
+import argparse
+import datetime
+import errno
+import json
+import os
+import shutil
+import threading
+from pathlib import Path
+
+from metrics import metrics
+
+TRASH_DIR = ".bms-trash"
+JOURNAL_DIR = Path("trash")
+
+
+def same_device_ancestors(folder):
+    """Return the ancestors of folder on its filesystem, mount point first, folder last."""
+    device = os.stat(folder).st_dev
+    chain = [folder]
+    for parent in folder.parents:
+        if os.stat(parent).st_dev != device:
+            break
+        chain.append(parent)
+    return device, chain[::-1]
+
+
+class Trash:
+    def __init__(self, run_id=None, root=None, journal_dir=JOURNAL_DIR):
+        """
+        Trash into `.bms-trash/<run_id>` at the top of each source's filesystem,
+        or into `root/<run_id>` for every source when root is given.
+        """
+        self.run_id = run_id or datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+        self.root = Path(root).absolute() if root else None
+        # device → trash bases found so far
+        self.bases = {}
+        # trash paths handed out to moves that may still be copying
+        self.reserved = set()
+        self.moved = 0
+
+        journal_dir = Path(journal_dir)
+        journal_dir.mkdir(parents=True, exist_ok=True)
+        self.journal_path = journal_dir / f"{self.run_id}.jsonl"
+        self._journal = None
+        # the v2 merge executor trashes and records from several threads
+        self._lock = threading.Lock()
+
+    def _trash_base(self, folder):
+        """Return the folder holding the trash for sources in `folder`."""
+        device = os.stat(folder).st_dev
+        for base in self.bases.get(device, ()):
+            if base == folder or base in folder.parents:
+                return base
+
+        _, candidates = same_device_ancestors(folder)
+        for base in candidates:
+            try:
+                (base / TRASH_DIR).mkdir(exist_ok=True)
+            except OSError:
+                # not writable here (no permission, read-only mount...), try further down
+                continue
+            self.bases.setdefault(device, []).append(base)
+            return base
+
+        raise PermissionError(f"no writable folder for a trash above {folder}")
+
+    def destination(self, src):
+        if self.root:
+            dest = self.root / self.run_id / src.relative_to(src.anchor)
+        else:
+            base = self._trash_base(src.parent)
+            dest = base / TRASH_DIR / self.run_id / src.relative_to(base)
+
+        # the same path can be trashed twice in a run, e.g. a file replaced by a merge
+        candidate = dest
+        n = 1
+        while candidate in self.reserved or os.path.lexists(candidate):
+            candidate = dest.with_name(f"{dest.name}.{n}")
+            n += 1
+        return candidate
+
+    def record(self, src, dest, op="trash"):
+        """Append a move to the journal so undo can reverse it."""
+        entry = {"op": op, "src": str(src), "dest": str(dest)}
+        with self._lock:
+            if self._journal is None:
+                self._journal = open(self.journal_path, "a", encoding="utf-8")
+            self._journal.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self._journal.flush()
+
+    def move(self, src):
+        """Move src into the trash. Returns False when it can't be moved for lack of permission."""
+        src = Path(src)
+        if not os.path.lexists(src):
+            return True
+
+        # resolve the parent only, so a symlink is trashed rather than its target
+        src = src.parent.resolve() / src.name
+
+        try:
+            # the name is reserved under the lock, a copy to a --trash-dir on
+            # another disk then doesn't hold up the other threads
+            with self._lock:
+                dest = self.destination(src)
+                self.reserved.add(dest)
+                dest.parent.mkdir(parents=True, exist_ok=True)
+            try:
+                os.rename(src, dest)
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+                shutil.move(src, dest)
+                metrics.count("trash_cross_device")
+        except PermissionError:
+            return False
+
+        self.record(src, dest)
+        with self._lock:
+            self.moved += 1
+        metrics.count("paths_trashed")
+        return True
+
+    def close(self):
+        if self._journal:
+            self._journal.close()
+            self._journal = None
+
+
+def move_back(src, dest):
+    try:
+        os.rename(dest, src)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.move(dest, src)
+
+
+def undo(journal_path):
+    """Move everything recorded in a journal back, newest first."""
+    journal_path = Path(journal_path)
+    with open(journal_path, encoding="utf-8") as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+
+    restored = 0
+    for entry in reversed(entries):
+        src, dest = Path(entry["src"]), Path(entry["dest"])
+
+        if not os.path.lexists(dest):
+            print(f"SKIP (no longer there): {dest}")
+            continue
+        if os.path.lexists(src):
+            print(f"SKIP (path is in use again): {src}")
+            continue
+
+        src.parent.mkdir(parents=True, exist_ok=True)
+        move_back(src, dest)
+        restored += 1
+
+    journal_path.rename(journal_path.with_suffix(".undone"))
+    print(f"Restored {restored}/{len(entries)} paths from {journal_path}")
+    return restored
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the journaled trash of the dup_search scripts.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    undo_parser = subparsers.add_parser("undo", help="Restore everything a run moved to the trash")
+    undo_parser.add_argument("journal", help="Journal of the run, e.g. trash/2024-01-01_12-00-00.jsonl")
+
+    subparsers.add_parser("list", help="List journals of runs that can be undone")
+
+    args = parser.parse_args()
+
+    if args.command == "undo":
+        undo(args.journal)
+    elif args.command == "list":
+        for journal in sorted(JOURNAL_DIR.glob("*.jsonl")):
+            with open(journal, encoding="utf-8") as f:
+                count = sum(1 for line in f if line.strip())
+            print(f"{journal}  ({count} paths)")
+
+
+if __name__ == "__main__":
+    main()